@@ -2,11 +2,11 @@
 import gevent.monkey
 gevent.monkey.patch_all()
 
-import json
 import logging
 import os
 
 from gpippy import Client
+from mrpippy import dump
 
 
 def main(host, outfile, level='INFO', interval='5'):
@@ -19,7 +19,8 @@ def main(host, outfile, level='INFO', interval='5'):
 			if os.path.exists(outfile):
 				os.rename(outfile, '{}.tmp'.format(outfile))
 			with open(outfile, 'w') as f:
-				f.write(json.dumps(client.pipdata.root.value, indent=4) + '\n')
+				dump(client.pipdata, f, indent=4, between_chunks=lambda: gevent.idle(0))
+				f.write('\n')
 	client.wait()
 
 
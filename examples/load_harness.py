@@ -0,0 +1,139 @@
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import json
+import logging
+import platform
+import resource
+import time
+
+import gevent
+
+from gpippy import Client, Simulator
+
+
+class MeasuredClient(Client):
+	"""Client which records decode cpu time and delivery latency of timestamped updates"""
+
+	def __init__(self, *args, **kwargs):
+		self.latencies = kwargs.pop('latencies')
+		self.decode_time = 0
+		self.updates = 0
+		super(MeasuredClient, self).__init__(*args, **kwargs)
+
+	def data_update(self, payload):
+		# unlike the normal client, we don't yield partway through so the cpu time is ours alone
+		start = time.clock()
+		updates = list(self.pipdata.decode_and_update(payload))
+		self.decode_time += time.clock() - start
+		self.updates += len(updates)
+		root = self.pipdata.root
+		if root and Simulator.STAMP_KEY in root:
+			stamp = root[Simulator.STAMP_KEY]
+			if stamp in updates:
+				self.latencies.append(time.time() - float(stamp.raw_value))
+		for callback in self.update_callbacks:
+			callback(updates)
+
+
+def percentile(values, p):
+	if not values:
+		return
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+def run(clients=10, duration=10, hp_rate=10, update_size=10, inventory_rate=1, map_rate=0, items=200):
+	"""Start a Simulator and the given number of clients, let them run for duration seconds,
+	and return a report dict."""
+	from gpippy.simulator import synthetic_state
+	simulator = Simulator(
+		state=synthetic_state(items),
+		host='127.0.0.1', port=0, discovery=False, stamp=True,
+		hp_rate=hp_rate, update_size=update_size, inventory_rate=inventory_rate, map_rate=map_rate,
+	)
+	simulator.start()
+
+	latencies = []
+	dropped = []
+	rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	connect_start = time.time()
+	running = []
+	for x in range(clients):
+		running.append(MeasuredClient(
+			'127.0.0.1', simulator.port,
+			latencies=latencies,
+			on_close=lambda ex: dropped.append(ex),
+		))
+	connect_time = time.time() - connect_start
+
+	# wait for every client to get the full state before measuring
+	while not all(client.pipdata.root for client in running):
+		gevent.sleep(0.1)
+	rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	del latencies[:]
+	for client in running:
+		client.decode_time = 0
+		client.updates = 0
+
+	gevent.sleep(duration)
+
+	decode_times = [client.decode_time for client in running]
+	report = {
+		'time': time.time(),
+		'python': platform.python_version(),
+		'config': {
+			'clients': clients,
+			'duration': duration,
+			'hp_rate': hp_rate,
+			'update_size': update_size,
+			'inventory_rate': inventory_rate,
+			'map_rate': map_rate,
+			'items': items,
+			'values': len(simulator.pipdata.id_map),
+		},
+		'connect_time': connect_time,
+		'latency': {
+			'samples': len(latencies),
+			'p50': percentile(latencies, 50),
+			'p90': percentile(latencies, 90),
+			'p99': percentile(latencies, 99),
+			'max': max(latencies) if latencies else None,
+		},
+		'updates_per_client': sum(client.updates for client in running) / float(clients),
+		'decode_cpu_per_client': sum(decode_times) / clients,
+		'decode_cpu_max': max(decode_times),
+		# ru_maxrss is in KB on linux
+		'memory_per_client_kb': (rss_after - rss_before) / float(clients),
+		'dropped_connections': len(dropped),
+	}
+	simulator.stop()
+	for client in running:
+		if not client.finished.ready():
+			client.close()
+	return report
+
+
+def main(clients='10', duration='10', outfile=None, hp_rate='10', update_size='10', inventory_rate='1', map_rate='0', level='WARNING'):
+	"""Runs the harness and writes a json report to outfile, or stdout"""
+	logging.basicConfig(level=level)
+	report = run(
+		clients=int(clients),
+		duration=float(duration),
+		hp_rate=float(hp_rate),
+		update_size=int(update_size),
+		inventory_rate=float(inventory_rate),
+		map_rate=float(map_rate),
+	)
+	report = json.dumps(report, indent=4, sort_keys=True) + '\n'
+	if outfile:
+		with open(outfile, 'w') as f:
+			f.write(report)
+	else:
+		print(report)
+
+
+if __name__ == '__main__':
+	import sys
+	main(*sys.argv[1:])
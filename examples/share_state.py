@@ -0,0 +1,37 @@
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import logging
+
+import gevent.event
+
+from gpippy import Client
+from mrpippy import SharedStateWriter
+from mrpippy.sharedstate import DEFAULT_PATH
+
+
+def main(host, path=DEFAULT_PATH, interval='0.1', level='INFO'):
+	"""Connect to host and publish its state to path for any number of local processes
+	to read with SharedStateReader. Publishes at most once every interval seconds."""
+	interval = float(interval)
+	logging.basicConfig(level=level)
+	writer = SharedStateWriter(path)
+	changed = gevent.event.Event()
+	# also wake on close, so we don't wait forever for changes that will never come
+	client = Client(host, on_changes=lambda changes: changed.set(), on_close=lambda ex: changed.set())
+	try:
+		while True:
+			changed.wait()
+			changed.clear()
+			if client.closing:
+				break
+			writer.publish(client.pipdata)
+			gevent.sleep(interval)
+	finally:
+		writer.close()
+
+
+if __name__ == '__main__':
+	import sys
+	main(*sys.argv[1:])
@@ -0,0 +1,27 @@
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import logging
+
+from gpippy import Simulator
+
+
+def main(state=None, port='27000', hp_rate='1', update_size='1', inventory_rate='0.2', map_rate='0', level='INFO'):
+	"""Serve a synthetic state (or a recorded one from dump_client.py) to any apps that connect."""
+	logging.basicConfig(level=level)
+	simulator = Simulator(
+		state=state or None,
+		port=int(port),
+		hp_rate=float(hp_rate),
+		update_size=int(update_size),
+		inventory_rate=float(inventory_rate),
+		map_rate=float(map_rate),
+	)
+	simulator.start()
+	simulator.group.join()
+
+
+if __name__ == '__main__':
+	import sys
+	main(*sys.argv[1:])
@@ -1 +1,5 @@
 from client import Client
+from mappoller import MapPoller
+from server import Server
+from simulator import Simulator
+from sessions import SessionManager
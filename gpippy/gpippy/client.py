@@ -1,11 +1,18 @@
 
 from gevent.event import AsyncResult
+import socket
+import time
+
 import gevent
+import gevent.lock
+import gevent.pool
+import gevent.queue
 
-from mrpippy import ClientConnection, RPCManager, MessageType
+from mrpippy import ClientConnection, RPCManager, RPCCancelled, MessageType, PipDataManager, LocalMap, ChangeSet
+from mrpippy import localmap
 from mrpippy.connection import ClientConnectionFromSocket
 
-from common import Service
+from common import Service, close_on_error
 
 
 def _do_rpc(name):
@@ -19,13 +26,57 @@ def _do_rpc(name):
 
 
 class Client(Service):
-	def __init__(self, host=None, port=27000, sock=None, on_update=None, on_close=None):
+	# size of the square tiles that local map updates are split into for on_map_update
+	MAP_TILE_SIZE = 32
+	# default timeout for blocking RPCs, and how often we check for expired RPCs
+	RPC_TIMEOUT = 10
+	RPC_EXPIRY_INTERVAL = 1
+	# most RPCs that may be awaiting a response at once
+	RPC_MAX_OUTSTANDING = 1024
+	# default number of requests rpc_batch() will have awaiting a response at once
+	RPC_BATCH_WINDOW = 16
+	# how often rpc_batch() checks whether the send queue has room for requests that don't get a response
+	RPC_BATCH_PACE_INTERVAL = 0.01
+	# bounds of the exponential backoff between reconnect attempts
+	RECONNECT_MIN_DELAY = 0.5
+	RECONNECT_MAX_DELAY = 30
+
+	def __init__(self, host=None, port=27000, sock=None, on_update=None, on_close=None, interests=None,
+	             on_map_update=None, stats_file=None, on_changes=None, intern_table=None, keepalive=True,
+	             reconnect=False, expire_rpcs=True):
 		"""on_update is an optional callback that is called with a list of updated values on DATA_UPDATE.
+		on_changes is an optional callback that is called with a ChangeSet on DATA_UPDATE, if anything changed.
 		Of host, port, sock, the following combinations can be given:
 			port only: Listen on port and use the first peer that connects
 			host, port: Connect to host, port
 			sock only: Use given socket
+		interests is an optional list of root keys (eg. ['PlayerInfo', 'Stats', 'Inventory']).
+		If given, data outside those subtrees is discarded and not passed to on_update.
+		on_map_update is an optional callback that is called with (local_map, tiles) on LOCAL_MAP_UPDATE,
+		where tiles is a list of (x, y, pixels) for only those tiles which changed since the last update.
+		See LocalMap.dirty_tiles(). This requires numpy.
+		stats_file is an optional path to periodically write stats to, see Service.
+		intern_table is an optional InternTable for decoded strings, which may be shared between clients.
+		keepalive=False disables sending our own keepalives, see Service.
+		expire_rpcs=False disables the greenlet that times out RPCs. You must then call
+		rpc.expire() regularly yourself, as SessionManager does.
+		If reconnect=True, when the peer closes the connection or it fails with a socket error
+		(but not other errors, eg. from callbacks), we keep trying to connect to host and port again,
+		with exponential backoff, instead of closing. pipdata is kept, and the full state sent on reconnect
+		is reconciled against it, so on_update and on_changes only see what actually changed.
+		Any outstanding RPCs fail with RPCCancelled. This requires host.
 		"""
+		if reconnect and host is None:
+			raise ValueError("reconnect requires a host to connect to")
+		self.host = host
+		self.port = port
+		self.reconnect = reconnect
+		self.expire_rpcs = expire_rpcs
+		self.reconnects = 0
+		# greenlet trying to reconnect, if any
+		self._reconnector = None
+		# whether the next DATA_UPDATE is the full state sent on reconnecting
+		self._reconciling = False
 		if sock:
 			self.conn = ClientConnectionFromSocket(sock)
 		elif host is None:
@@ -38,18 +89,82 @@ class Client(Service):
 			self.conn = ClientConnectionFromSocket(sock)
 		else:
 			self.conn = ClientConnection(host, port)
-		self.rpc = RPCManager()
+		self.rpc = RPCManager(timeout=self.RPC_TIMEOUT, max_outstanding=self.RPC_MAX_OUTSTANDING)
 		self.update_callbacks = set()
 		if on_update:
 			self.update_callbacks.add(on_update)
-		super(Client, self).__init__(on_close=on_close)
+		self.change_callbacks = set()
+		if on_changes:
+			self.change_callbacks.add(on_changes)
+		self.local_map = None
+		self._next_map = AsyncResult()
+		# greenlets for the life of the client rather than of one connection, so they survive
+		# reconnecting. They are killed on close. Helpers like MapPoller also run here.
+		self.background = gevent.pool.Group()
+		self.map_callbacks = set()
+		if on_map_update:
+			if localmap.numpy is None:
+				raise ImportError("on_map_update requires numpy")
+			self.map_callbacks.add(on_map_update)
+		super(Client, self).__init__(
+			on_close=on_close,
+			pipdata=PipDataManager(interests=interests, intern_table=intern_table),
+			stats_file=stats_file,
+			keepalive=keepalive,
+		)
+		# wake anyone still waiting on a response
+		self.on_close.add(lambda ex: self.rpc.cancel_all())
+		self.on_close.add(lambda ex: self.background.kill())
+		if self.expire_rpcs:
+			self.background.spawn(self._expire_rpcs)
+
+	def connection_lost(self, ex=None):
+		# only reconnect if the connection itself failed, not eg. because a callback raised,
+		# which would likely just happen again
+		if not self.reconnect or self.closing or not (ex is None or isinstance(ex, (socket.error, EOFError))):
+			self.close(ex)
+			return
+		if self._reconnector is None:
+			self.log.warning("Connection lost ({}), reconnecting".format(ex))
+			# we may be running in one of the greenlets that _reconnect() kills
+			self._reconnector = gevent.spawn(self._reconnect)
+
+	def _reconnect(self):
+		self.group.kill(block=True)
+		self.conn.socket.close()
+		self.rpc.cancel_all()
+		# anything queued from now on is sent once we're connected
+		self.send_queue = gevent.queue.Queue()
+		delay = self.RECONNECT_MIN_DELAY
+		while True:
+			try:
+				conn = ClientConnection(self.host, self.port)
+			except Exception as ex:
+				self.log.info("Failed to reconnect ({}), retrying in {}s".format(ex, delay))
+				gevent.sleep(delay)
+				delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+			else:
+				break
+		self.log.info("Reconnected")
+		self.conn = conn
+		self.last_sent = self.last_received = time.time()
+		self._reconciling = True
+		self.reconnects += 1
+		self._reconnector = None
+		self._start()
+
+	def close(self, ex=None):
+		if self._reconnector is not None:
+			self._reconnector.kill()
+			self._reconnector = None
+		super(Client, self).close(ex)
 
 	def process(self, message_type, payload):
 		IGNORE = lambda payload: None
 		DISPATCH = {
 			MessageType.KEEP_ALIVE: IGNORE,
 			MessageType.DATA_UPDATE: self.data_update,
-			MessageType.LOCAL_MAP_UPDATE: IGNORE, # we don't understand maps yet
+			MessageType.LOCAL_MAP_UPDATE: self.map_update,
 			MessageType.COMMAND_RESULT: self.rpc.recv,
 		}
 
@@ -61,21 +176,60 @@ class Client(Service):
 
 	def data_update(self, payload):
 		updates = []
-		for n, update in enumerate(self.pipdata.decode_and_update(payload)):
-			# since payload may be very large, give other greenlets a chance to run
+		# only track changes if someone wants them
+		changes = ChangeSet() if self.change_callbacks else None
+		if self._reconciling:
+			self._reconciling = False
+			updates_iter = self.pipdata.reconcile(payload, changes)
+		else:
+			updates_iter = self.pipdata.decode_and_update(payload, changes)
+		for n, update in enumerate(updates_iter):
+			# since payload may be very large, give other greenlets a chance to run.
+			# They may see a partially-applied update, unless they read from a self.pipdata.snapshot().
 			if n % 100 == 0:
 				gevent.idle(0)
 			updates.append(update)
 		for callback in self.update_callbacks:
 			callback(updates)
+		if changes:
+			for callback in self.change_callbacks:
+				callback(changes)
+
+	def map_update(self, payload):
+		previous = self.local_map
+		self.local_map = LocalMap.decode(payload)
+		next_map, self._next_map = self._next_map, AsyncResult()
+		next_map.set(self.local_map)
+		if not self.map_callbacks:
+			return
+		tiles = self.local_map.dirty_tiles(previous, self.MAP_TILE_SIZE)
+		if not tiles:
+			return
+		for callback in self.map_callbacks:
+			callback(self.local_map, tiles)
+
+	def next_map(self, timeout=None):
+		"""Block until the next LOCAL_MAP_UPDATE arrives, and return the LocalMap.
+		Raises gevent.Timeout if timeout is given and expires first."""
+		return self._next_map.get(timeout=timeout)
+
+	@close_on_error
+	def _expire_rpcs(self):
+		while True:
+			gevent.sleep(self.RPC_EXPIRY_INTERVAL)
+			self.rpc.expire()
 
 	def do_rpc(self, method, *args, **kwargs):
+		"""Send an RPC request. If kwarg block=True, wait for and return the response.
+		In that case, kwarg timeout overrides the default RPC_TIMEOUT, and an RPCTimeout
+		is raised if it expires. RPCCancelled is raised if the client closes while waiting."""
 		block = kwargs.pop('block', False)
+		timeout = kwargs.pop('timeout', self.RPC_TIMEOUT)
 		if kwargs:
 			raise ValueError("Unexpected kwargs: {}".format(kwargs))
 		if block:
 			result = AsyncResult()
-			request = method(*args, callback=lambda v: result.set(v))
+			request = method(*args, callback=result.set, errback=result.set_exception, timeout=timeout)
 		else:
 			request = method(*args)
 		self.send(MessageType.COMMAND, request)
@@ -83,4 +237,85 @@ class Client(Service):
 		if block:
 			return result.get()
 
+	def rpc_batch(self, requests, window=None, timeout=None):
+		"""Send many RPCs without waiting a round trip for each one.
+		requests is a list of (method name, arg, ...), eg. [('use_item', handle_id, version), ...].
+		At most window requests will be awaiting a response at any one time (default RPC_BATCH_WINDOW).
+		Request types that don't get a response (eg. use_item) are instead held back while window or more
+		messages are waiting in our send queue. Since the game never acknowledges them, this can't limit
+		how many it has received but not yet processed.
+		timeout is per request, and defaults to RPC_TIMEOUT.
+		Returns a list of AsyncResults, in the same order as requests. Each is set to the response,
+		or for request types that don't get a response, to None once the request is queued for sending.
+		If building or sending a request fails, its AsyncResult is set to the exception and the rest continue.
+		Raises ValueError, without sending anything, if any method name is unknown.
+		"""
+		window = self.RPC_BATCH_WINDOW if window is None else window
+		timeout = self.RPC_TIMEOUT if timeout is None else timeout
+		for request in requests:
+			try:
+				self.rpc.expects_reply(request[0])
+			except KeyError:
+				raise ValueError("Unknown RPC method: {!r}".format(request[0]))
+		slots = gevent.lock.BoundedSemaphore(window)
+		results = [AsyncResult() for request in requests]
+
+		def send_one(name, args, result):
+			method = getattr(self.rpc, name)
+			if not self.rpc.expects_reply(name):
+				request = method(*args)
+				while self.send_queue.qsize() >= window:
+					gevent.sleep(self.RPC_BATCH_PACE_INTERVAL)
+				self.send(MessageType.COMMAND, request)
+				result.set(None)
+				return
+			slots.acquire()
+			def callback(response):
+				slots.release()
+				result.set(response)
+			def errback(ex):
+				slots.release()
+				result.set_exception(ex)
+			try:
+				request = method(*args, callback=callback, errback=errback, timeout=timeout)
+			except Exception as ex:
+				errback(ex)
+				return
+			self.send(MessageType.COMMAND, request)
+
+		def send_all():
+			sent = 0
+			try:
+				for request, result in zip(requests, results):
+					name, args = request[0], request[1:]
+					try:
+						send_one(name, args, result)
+					except Exception as ex:
+						self.log.warning("Failed to send batched RPC {}{}: {}".format(name, args, ex))
+						result.set_exception(ex)
+					sent += 1
+			finally:
+				# if we were killed (ie. the client closed), nothing else will set these
+				for result in results[sent:]:
+					if not result.ready():
+						result.set_exception(RPCCancelled("Batched request was never sent"))
+
+		self.log.info("Sending batch of {} RPCs".format(len(requests)))
+		self.background.spawn(send_all)
+		return results
+
 	use_item = _do_rpc('use_item')
+	drop_item = _do_rpc('drop_item')
+	set_favorite = _do_rpc('set_favorite')
+	toggle_component_favorite = _do_rpc('toggle_component_favorite')
+	sort_inventory = _do_rpc('sort_inventory')
+	toggle_quest_active = _do_rpc('toggle_quest_active')
+	set_custom_map_marker = _do_rpc('set_custom_map_marker')
+	remove_custom_map_marker = _do_rpc('remove_custom_map_marker')
+	check_fast_travel = _do_rpc('check_fast_travel')
+	fast_travel = _do_rpc('fast_travel')
+	clear_idle = _do_rpc('clear_idle')
+	toggle_radio_station = _do_rpc('toggle_radio_station')
+	request_local_map_snapshot = _do_rpc('request_local_map_snapshot')
+	move_local_map = _do_rpc('move_local_map')
+	zoom_local_map = _do_rpc('zoom_local_map')
@@ -3,6 +3,7 @@ import errno
 import functools
 import logging
 import socket
+import time
 
 import gevent
 import gevent.event
@@ -11,47 +12,74 @@ import gevent.queue
 
 from mrpippy import PipDataManager, MessageType
 
+from stats import ServiceStats
+
 
 def close_on_error(fn):
-	"""Decorator that calls self.close() if a method raises or returns"""
+	"""Decorator that calls self.connection_lost() (which by default closes) if a method raises or returns"""
 	@functools.wraps(fn)
 	def _wrapper(self, *args, **kwargs):
 		try:
 			fn(self, *args, **kwargs)
 		except Exception as ex:
 			self.log.exception("Error in {}".format(fn))
-			self.close(ex)
+			self.connection_lost(ex)
 		else:
-			self.close()
+			self.connection_lost()
 	return _wrapper
 
 
 class Service(object):
 	KEEPALIVE_TIMEOUT = 2
-
-	def __init__(self, on_close=None):
-		"""Subclasses should set self.conn before calling super()"""
+	# how often to write stats_file
+	STATS_INTERVAL = 10
+
+	def __init__(self, on_close=None, pipdata=None, stats_file=None, keepalive=True):
+		"""Subclasses should set self.conn before calling super().
+		pipdata is the PipDataManager to use, by default a new one is created.
+		If stats_file is given, stats are periodically written to it in prometheus text format.
+		If keepalive is False, we don't send keepalives ourselves, eg. because a SessionManager is."""
 		self.group = gevent.pool.Group()
 		self.log = logging.getLogger('gpippy.{}.{:x}'.format(type(self).__name__, id(self)))
 
-		self.pipdata = PipDataManager()
+		self.pipdata = PipDataManager() if pipdata is None else pipdata
+		self.stats_file = stats_file
+		self.keepalive = keepalive
+		self._stats = ServiceStats()
 		self.send_queue = gevent.queue.Queue()
+		# times we last sent or received a message
+		self.last_sent = self.last_received = time.time()
 		self.closing = False
 		self.on_close = set()
 		self.finished = gevent.event.AsyncResult()
 		if on_close:
 			self.on_close.add(on_close)
 
+		self._start()
+
+	def _start(self):
+		"""Spawn the greenlets that run the connection"""
 		self.group.spawn(self._send_loop)
 		self.group.spawn(self._recv_loop)
-		self.group.spawn(self._keepalive)
+		if self.keepalive:
+			self.group.spawn(self._keepalive)
+		if self.stats_file:
+			self.group.spawn(self._write_stats)
+
+	def connection_lost(self, ex=None):
+		"""Called when the connection fails or the peer closes it, with the error if any.
+		By default this closes, but subclasses may override it, eg. to reconnect."""
+		self.close(ex)
 
 	@close_on_error
 	def _send_loop(self):
 		for message_type, payload in self.send_queue:
 			try:
-				self.log.debug("Sending message of type {}: {!r}".format(message_type, payload))
+				if self.log.isEnabledFor(logging.DEBUG):
+					self.log.debug("Sending message of type {} ({} bytes)".format(message_type, len(payload)))
 				self.conn.send(message_type, payload)
+				self.last_sent = time.time()
+				self._stats.sent(message_type, len(payload))
 			except socket.error as ex:
 				if ex.errno == errno.EPIPE:
 					self.log.info("Peer closed connection")
@@ -66,16 +94,41 @@ class Service(object):
 			except EOFError:
 				self.log.info("Peer closed connection")
 				return
-			self.log.debug("Received message of type {}: {!r}".format(message_type, payload))
+			self.last_received = time.time()
+			self._stats.received(message_type, len(payload))
+			if self.log.isEnabledFor(logging.DEBUG):
+				self.log.debug("Received message of type {} ({} bytes)".format(message_type, len(payload)))
+			start = time.time()
 			self.process(message_type, payload)
+			self._stats.processed(message_type, time.time() - start)
 
 	@close_on_error
 	def _keepalive(self):
 		# other sources suggest official game/app can get picky about sending too many keepalives?
+		# so we only send one once nothing else has been sent for KEEPALIVE_TIMEOUT
 		while True:
-			gevent.sleep(self.KEEPALIVE_TIMEOUT)
+			delay = self.last_sent + self.KEEPALIVE_TIMEOUT - time.time()
+			if delay > 0:
+				gevent.sleep(delay)
+				continue
 			self.log.info("Sending keepalive")
 			self.send(MessageType.KEEP_ALIVE, "")
+			# don't wait for the send loop to get to it before we count it
+			self.last_sent = time.time()
+
+	@close_on_error
+	def _write_stats(self):
+		while True:
+			gevent.sleep(self.STATS_INTERVAL)
+			self.write_stats()
+
+	def stats(self):
+		"""Returns a dict of stats about this connection, see ServiceStats.as_dict()"""
+		return self._stats.as_dict()
+
+	def write_stats(self, path=None):
+		"""Write stats in prometheus text format to path, by default self.stats_file"""
+		self._stats.write_prometheus(path or self.stats_file, service=type(self).__name__, id='{:x}'.format(id(self)))
 
 	def close(self, ex=None):
 		if self.closing:
@@ -102,6 +155,7 @@ class Service(object):
 
 	def send(self, message_type, payload):
 		self.send_queue.put((message_type, payload))
+		self._stats.queued(self.send_queue.qsize())
 
 	def process(self, message_type, payload):
 		"""Override this with behaviour upon message recieve.
@@ -0,0 +1,138 @@
+
+from collections import deque
+import time
+
+import gevent
+
+from mrpippy.data import Player
+
+
+class MapPoller(object):
+	"""Requests local map snapshots from the server at up to a target frame rate.
+	Only one snapshot request is ever outstanding at a time.
+	The rate is reduced to idle_fps while the player is stationary, and backs off further
+	if the link appears congested (requests time out or the send queue is backing up).
+	Received maps arrive via the client as normal, see Client.local_map and on_map_update.
+	"""
+	# how many seconds the player's coordinates must be unchanged before we consider them stationary
+	IDLE_AFTER = 2
+	# send queue length above which we consider the link congested
+	MAX_QUEUE = 10
+	# upper limit on the multiplier applied to the poll interval when congested
+	MAX_BACKOFF = 16
+	# weight given to each new latency sample in the moving average
+	LATENCY_WEIGHT = 0.2
+
+	def __init__(self, client, fps=10, idle_fps=1, timeout=2):
+		"""timeout is how long to wait for a snapshot before giving up on it and sending another request."""
+		self.client = client
+		self.fps = fps
+		self.idle_fps = idle_fps
+		self.timeout = timeout
+		self.backoff = 1
+		self.latency = None # moving average of request latency
+		self.requests = 0
+		self.timeouts = 0
+		self.frame_times = deque(maxlen=max(2, int(fps * 5)))
+		self._coordinates = None
+		self._moved_at = 0
+		# reused between polls so its resolved paths stay cached, see player
+		self._player = None
+		self.greenlet = None
+
+	def start(self):
+		if self.greenlet is None:
+			# in background, so that we keep polling across reconnects
+			self.greenlet = self.client.background.spawn(self._run)
+			self.greenlet.link(self._stopped)
+
+	def _stopped(self, greenlet):
+		if self.greenlet is greenlet:
+			self.greenlet = None
+
+	def stop(self):
+		if self.greenlet is not None:
+			self.greenlet.kill()
+			self.greenlet = None
+
+	@property
+	def player(self):
+		"""The Player for the client's data, or None if the root hasn't arrived yet"""
+		root = self.client.pipdata.root
+		if root is None:
+			return
+		if self._player is None or self._player.root is not root:
+			self._player = Player(root)
+		return self._player
+
+	@property
+	def stationary(self):
+		"""Whether the player has not moved for the last IDLE_AFTER seconds.
+		If the player's position is not known, we assume they are moving."""
+		try:
+			coordinates = self.player.coordinates
+		except (AttributeError, KeyError, TypeError):
+			return False
+		now = time.time()
+		if coordinates != self._coordinates:
+			self._coordinates = coordinates
+			self._moved_at = now
+		return now - self._moved_at >= self.IDLE_AFTER
+
+	@property
+	def congested(self):
+		return self.client.send_queue.qsize() > self.MAX_QUEUE
+
+	@property
+	def interval(self):
+		"""The current target time between snapshot requests"""
+		fps = self.idle_fps if self.stationary else self.fps
+		return self.backoff / float(fps)
+
+	@property
+	def achieved_fps(self):
+		"""Rate of snapshots actually received, averaged over recent frames"""
+		if len(self.frame_times) < 2:
+			return 0.
+		elapsed = self.frame_times[-1] - self.frame_times[0]
+		if elapsed <= 0:
+			return 0.
+		return (len(self.frame_times) - 1) / elapsed
+
+	def stats(self):
+		return {
+			'fps': self.achieved_fps,
+			'latency': self.latency,
+			'requests': self.requests,
+			'timeouts': self.timeouts,
+			'backoff': self.backoff,
+		}
+
+	def _run(self):
+		while True:
+			start = time.time()
+			if self.congested:
+				self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+			else:
+				self.poll()
+			gevent.sleep(max(0, start + self.interval - time.time()))
+
+	def poll(self):
+		"""Request one snapshot and wait for it to arrive, updating stats and backoff."""
+		start = time.time()
+		self.requests += 1
+		self.client.request_local_map_snapshot()
+		try:
+			self.client.next_map(timeout=self.timeout)
+		except gevent.Timeout:
+			self.timeouts += 1
+			self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+			return
+		now = time.time()
+		latency = now - start
+		if self.latency is None:
+			self.latency = latency
+		else:
+			self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+		self.frame_times.append(now)
+		self.backoff = max(1, self.backoff / 2)
@@ -0,0 +1,58 @@
+
+import gevent.pool
+
+from mrpippy import ServerConnection, RPCServer, MessageType
+
+from common import Service
+
+
+class Server(Service):
+	"""Serves a PipDataManager's state to one connected app.
+	On connect, the full state is sent. COMMANDs are handled by an RPCServer,
+	with each request running in its own greenlet so slow handlers don't block receiving.
+	Any resulting changes are sent as a DATA_UPDATE via update()."""
+	# max number of commands being handled at once
+	MAX_CONCURRENT_COMMANDS = 64
+
+	def __init__(self, sock, pipdata=None, rpc=None, version=None, language=None, on_close=None, stats_file=None, keepalive=True):
+		"""sock should be an already-connected socket, as returned by accept().
+		rpc is the RPCServer to use, by default one is created which modifies pipdata.
+		Note that if pipdata is given, its root should be populated before calling this,
+		as the full state is only sent once on connect."""
+		self.conn = ServerConnection(sock, version=version, language=language)
+		self.commands = gevent.pool.Pool(self.MAX_CONCURRENT_COMMANDS)
+		super(Server, self).__init__(on_close=on_close, pipdata=pipdata, stats_file=stats_file, keepalive=keepalive)
+		self.rpc = RPCServer(self.pipdata) if rpc is None else rpc
+		if self.pipdata.root:
+			self.send(MessageType.DATA_UPDATE, self.pipdata.full_state())
+
+	def close(self, ex=None):
+		self.commands.kill(block=False)
+		super(Server, self).close(ex)
+
+	def process(self, message_type, payload):
+		if message_type == MessageType.KEEP_ALIVE:
+			return
+		if message_type != MessageType.COMMAND:
+			self.log.warning("Unexpected message type {}, ignoring".format(message_type))
+			return
+		# wait for a free slot, which provides backpressure if handlers are slow
+		self.commands.spawn(self.command, payload)
+
+	def command(self, payload):
+		try:
+			response = self.rpc.get_response(payload)
+		except Exception:
+			self.log.exception("Error handling command {!r}".format(payload))
+			return
+		if response is not None:
+			self.send(MessageType.COMMAND_RESULT, response)
+		updates = self.rpc.pop_updates()
+		if updates:
+			self.update(updates)
+
+	def update(self, payload):
+		"""Called with an encoded DATA_UPDATE payload when command handling has changed the data.
+		By default this sends it to our peer, but you may override it, eg. to send it to all peers
+		sharing the same data."""
+		self.send(MessageType.DATA_UPDATE, payload)
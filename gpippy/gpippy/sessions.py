@@ -0,0 +1,178 @@
+
+import logging
+import math
+import socket
+import time
+
+import gevent
+import gevent.pool
+
+from mrpippy import MessageType
+
+from client import Client
+from server import Server
+
+
+class PeerTimeout(socket.error):
+	"""Nothing was received from a session's peer for too long. Like other socket errors,
+	this closes the session, or makes a Client with reconnect=True reconnect."""
+
+
+class TimerWheel(object):
+	"""Schedules keys to expire after a delay, with a resolution of tick seconds.
+	Scheduling and cancelling are O(1), and advancing is O(expired keys + elapsed ticks),
+	however many keys are scheduled. Delays longer than one revolution (tick * slots) are fine,
+	they just stay in their slot for more than one revolution."""
+
+	def __init__(self, tick=0.1, slots=512, now=None):
+		self.tick = tick
+		# each slot maps key: absolute tick number it expires at
+		self.slots = [{} for x in range(slots)]
+		# maps key: absolute tick number it expires at, for cancelling
+		self.deadlines = {}
+		# the last tick number we have advanced to
+		self.current = self._tick_number(time.time() if now is None else now)
+
+	def __len__(self):
+		return len(self.deadlines)
+
+	def __contains__(self, key):
+		return key in self.deadlines
+
+	def _tick_number(self, now):
+		return int(math.floor(now / self.tick))
+
+	def schedule(self, key, delay):
+		"""Expire key after delay seconds (rounded up to a tick). Any existing schedule for key is replaced."""
+		self.cancel(key)
+		deadline = self.current + max(1, int(math.ceil(delay / self.tick)))
+		self.deadlines[key] = deadline
+		self.slots[deadline % len(self.slots)][key] = deadline
+
+	def cancel(self, key):
+		"""Un-schedule key. Does nothing if it isn't scheduled."""
+		deadline = self.deadlines.pop(key, None)
+		if deadline is not None:
+			del self.slots[deadline % len(self.slots)][key]
+
+	def advance(self, now=None):
+		"""Advance time to now, returning a list of keys that have expired"""
+		target = self._tick_number(time.time() if now is None else now)
+		expired = []
+		# no need to visit a slot more than once
+		for tick in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+			slot = self.slots[tick % len(self.slots)]
+			for key, deadline in slot.items():
+				if deadline <= target:
+					expired.append(key)
+					del slot[key]
+					del self.deadlines[key]
+		self.current = max(self.current, target)
+		return expired
+
+
+class SessionManager(object):
+	"""Hosts many Services (Clients and Servers) in one process. Instead of each having its own
+	keepalive greenlet, one greenlet handles keepalives, idle timeouts and (for Clients) RPC timeouts
+	for all of them using a TimerWheel.
+	A keepalive is only sent to a peer once nothing else has been sent to it for keepalive_interval,
+	and a session whose peer has sent nothing (not even a keepalive) for idle_timeout is treated as having
+	lost its connection with PeerTimeout, ie. it is closed, or a Client with reconnect=True reconnects.
+	"""
+	KEEPALIVE_INTERVAL = 2
+	IDLE_TIMEOUT = 10
+	TICK = 0.1
+
+	def __init__(self, keepalive_interval=KEEPALIVE_INTERVAL, idle_timeout=IDLE_TIMEOUT, tick=TICK):
+		"""idle_timeout may be None to never close idle sessions"""
+		self.log = logging.getLogger('gpippy.{}.{:x}'.format(type(self).__name__, id(self)))
+		self.keepalive_interval = keepalive_interval
+		self.idle_timeout = idle_timeout
+		self.sessions = set()
+		self.wheel = TimerWheel(tick)
+		self.keepalives_sent = 0
+		self.evicted = 0
+		self.group = gevent.pool.Group()
+		self.group.spawn(self._run)
+
+	def client(self, *args, **kwargs):
+		"""Create a Client with the given args and add it"""
+		return self.add(Client(*args, keepalive=False, expire_rpcs=False, **kwargs))
+
+	def server(self, sock, **kwargs):
+		"""Create a Server for the given (already accepted) socket with the given kwargs and add it"""
+		return self.add(Server(sock, keepalive=False, **kwargs))
+
+	def add(self, service):
+		"""Manage an existing Service, which should have been created with keepalive=False.
+		Clients created with expire_rpcs=False also have their RPCs timed out. Returns the service."""
+		self.sessions.add(service)
+		service.on_close.add(lambda ex: self.remove(service))
+		self._schedule_keepalive(service, time.time())
+		self._schedule_idle(service, time.time())
+		if self._manages_rpcs(service):
+			self._schedule_rpcs(service)
+		return service
+
+	def remove(self, service):
+		"""Stop managing service, without closing it"""
+		self.sessions.discard(service)
+		self.wheel.cancel((service, 'keepalive'))
+		self.wheel.cancel((service, 'idle'))
+		self.wheel.cancel((service, 'rpcs'))
+
+	def _schedule_keepalive(self, service, now):
+		self.wheel.schedule((service, 'keepalive'), service.last_sent + self.keepalive_interval - now)
+
+	def _manages_rpcs(self, service):
+		return isinstance(service, Client) and not service.expire_rpcs
+
+	def _schedule_rpcs(self, service):
+		self.wheel.schedule((service, 'rpcs'), service.RPC_EXPIRY_INTERVAL)
+
+	def _schedule_idle(self, service, now):
+		if self.idle_timeout is not None:
+			self.wheel.schedule((service, 'idle'), service.last_received + self.idle_timeout - now)
+
+	def _run(self):
+		while True:
+			gevent.sleep(self.wheel.tick)
+			now = time.time()
+			for service, kind in self.wheel.advance(now):
+				if service.closing:
+					continue
+				if kind == 'keepalive':
+					# if something has been sent since we scheduled this, we only need to check again later
+					if now - service.last_sent >= self.keepalive_interval:
+						service.send(MessageType.KEEP_ALIVE, "")
+						self.keepalives_sent += 1
+						service.last_sent = now
+					self._schedule_keepalive(service, now)
+				elif kind == 'rpcs':
+					service.rpc.expire(now)
+					self._schedule_rpcs(service)
+				else:
+					if now - service.last_received >= self.idle_timeout:
+						self.log.warning("Evicting {}: nothing received for {}s".format(service, now - service.last_received))
+						self.evicted += 1
+						# close() blocks until the service's greenlets are dead, don't hold up other sessions
+						self.group.spawn(service.connection_lost, PeerTimeout("Nothing received for {}s".format(now - service.last_received)))
+						# if it reconnects instead of closing, give it a full idle_timeout to do so
+						# (if it closes, it is removed and this is cancelled)
+						self.wheel.schedule((service, 'idle'), self.idle_timeout)
+					else:
+						self._schedule_idle(service, now)
+
+	def stats(self):
+		return {
+			'sessions': len(self.sessions),
+			'timers': len(self.wheel),
+			'keepalives_sent': self.keepalives_sent,
+			'evicted': self.evicted,
+		}
+
+	def close(self):
+		"""Close all sessions and stop"""
+		for service in list(self.sessions):
+			service.close()
+		self.group.kill()
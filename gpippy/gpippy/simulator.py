@@ -0,0 +1,285 @@
+
+import json
+import logging
+import random
+import socket
+import time
+
+import gevent
+import gevent.pool
+import gevent.socket
+
+from mrpippy import DiscoverServer, LocalMap, MessageType, PipDataManager, RequestType, RPCServer, ValueType
+
+from server import Server
+
+
+def synthetic_item(handle_id, name='Thing', count=1, equip_state=None):
+	item = {
+		'text': name,
+		'HandleID': handle_id,
+		'StackID': [handle_id],
+		'count': count,
+		'favorite': -1,
+		'canFavorite': True,
+		'itemCardInfoList': [
+			{'text': '$val', 'Value': random.randint(1, 100)},
+			{'text': '$wt', 'Value': random.random() * 10},
+		],
+	}
+	if equip_state is not None:
+		item['equipState'] = equip_state
+	return item
+
+
+def synthetic_state(items=200):
+	"""Returns a nested structure resembling the game's state, with the given number of inventory items"""
+	categories = ['29', '35', '43', '48']
+	inventory = {category: [] for category in categories}
+	for handle_id in range(items):
+		category = categories[handle_id % len(categories)]
+		equip_state = 0 if category in ('29', '43') else None
+		inventory[category].append(synthetic_item(handle_id, '{} {}'.format(category, handle_id), equip_state=equip_state))
+	inventory.update({'Version': 1, 'sortMode': 0, 'invComponents': []})
+	return {
+		'PlayerInfo': {
+			'PlayerName': 'Nate',
+			'CurrHP': 250., 'MaxHP': 250.,
+			'XPLevel': 20, 'XPProgressPct': 0.5,
+			'CurrWeight': 150., 'MaxWeight': 250.,
+			'TimeHour': 12., 'DateYear': 287, 'DateMonth': 10, 'DateDay': 23,
+		},
+		'Stats': {
+			'{}Condition'.format(part): 100.
+			for part in ['Head', 'RLeg', 'RArm', 'LLeg', 'LArm', 'Torso']
+		},
+		'Status': {
+			flag: False for flag in [
+				'IsInAutoVanity', 'IsPlayerDead', 'IsMenuOpen', 'IsInVats', 'IsInVatsPlayback',
+				'IsPlayerPipboyLocked', 'IsPlayerMovementLocked', 'IsPipboyNotEquipped', 'IsLoading',
+			]
+		},
+		'Map': {
+			'CurrCell': '',
+			'CurrWorldspace': 'Commonwealth',
+			'World': {
+				'Player': {'X': 0., 'Y': 0., 'Rotation': 0.},
+				'CustomMarker': {'X': 0., 'Y': 0., 'Visible': False},
+			},
+		},
+		'Radio': [
+			{'text': name, 'active': False, 'inRange': True}
+			for name in ['Diamond City Radio', 'Classical Radio', 'Radio Freedom']
+		],
+		'Special': [{'Value': 5, 'Modifier': 0} for x in range(7)],
+		'Perks': [],
+		'Quests': [],
+		'Inventory': inventory,
+	}
+
+
+def load_state(path):
+	"""Load a recorded state, as written by examples/dump_client.py"""
+	with open(path) as f:
+		return json.load(f)
+
+
+class SimulatedServer(Server):
+	"""Server for one peer of a Simulator"""
+
+	def __init__(self, simulator, sock):
+		self.simulator = simulator
+		super(SimulatedServer, self).__init__(sock, pipdata=simulator.pipdata, rpc=simulator.rpc, version='1.0', language='en')
+
+	def command(self, payload):
+		try:
+			request_type = json.loads(payload)['type']
+		except Exception:
+			request_type = None # malformed, Server.command() will log it
+		if request_type == RequestType.RequestLocalMapSnapshot:
+			self.send(MessageType.LOCAL_MAP_UPDATE, self.simulator.local_map.encode())
+		super(SimulatedServer, self).command(payload)
+
+	def update(self, payload):
+		self.simulator.broadcast(MessageType.DATA_UPDATE, payload)
+
+
+class Simulator(object):
+	"""Pretends to be the game, serving a synthetic or recorded state to any number of apps,
+	and generating DATA_UPDATE churn at configurable rates. RPCs are answered by an RPCServer,
+	with changes seen by all peers.
+
+	Rates are in updates per second. 0 disables that kind of update.
+		hp_rate: Change CurrHP, plus update_size - 1 other random values from CHURN_PATHS (as many as exist), in one update.
+		inventory_rate: Change an item's count, or add or remove an item.
+		map_rate: Send a new local map of map_size to all peers. Maps are also sent when requested.
+
+	If stamp=True, the root gets an extra STAMP_KEY string value which is set to the current time
+	(as per time.time()) in every generated update, so peers can measure delivery latency.
+	"""
+	STAMP_KEY = 'SimTimestamp'
+	# stat-like values that hp_tick() may change. Ids and versions are left alone,
+	# so that RPCs (which refer to items by HandleID) still match what peers see.
+	CHURN_PATHS = [
+		('PlayerInfo', key) for key in ['XPProgressPct', 'CurrWeight', 'TimeHour']
+	] + [
+		('Stats', '{}Condition'.format(part)) for part in ['Head', 'RLeg', 'RArm', 'LLeg', 'LArm', 'Torso']
+	] + [
+		('Map', 'World', 'Player', key) for key in ['X', 'Y', 'Rotation']
+	]
+
+	def __init__(self, state=None, host='0.0.0.0', port=27000, discovery=True,
+	             hp_rate=1, update_size=1, inventory_rate=0.2, map_rate=0, map_size=(256, 256), stamp=False):
+		"""state is nested python data as per PipDataManager.from_value(), or a path to a recorded state to load.
+		By default a synthetic state is generated."""
+		self.log = logging.getLogger('gpippy.{}.{:x}'.format(type(self).__name__, id(self)))
+		if state is None:
+			state = synthetic_state()
+		elif isinstance(state, basestring):
+			state = load_state(state)
+		if stamp:
+			state = dict(state)
+			state[self.STAMP_KEY] = repr(time.time())
+		self.stamp = stamp
+		self.pipdata = PipDataManager.from_value(state)
+		self.rpc = RPCServer(self.pipdata)
+		self.host = host
+		self.port = port
+		self.discovery = discovery
+		self.hp_rate = hp_rate
+		self.update_size = update_size
+		self.inventory_rate = inventory_rate
+		self.map_rate = map_rate
+		width, height = map_size
+		self.local_map = LocalMap(width, height, (0., 0.), (1., 0.), (0., 1.), '\0' * (width * height))
+		self.servers = set()
+		self.group = gevent.pool.Group()
+		self.numeric_values = []
+		for path in self.CHURN_PATHS:
+			value = self.pipdata.root
+			for key in path:
+				if value.value_type != ValueType.OBJECT or key not in value:
+					value = None
+					break
+				value = value[key]
+			if value is not None and value.value_type in (ValueType.INT_32, ValueType.FLOAT):
+				self.numeric_values.append(value)
+		# handle ids for new items, above any existing ones
+		handle_ids = [
+			item['HandleID']
+			for items in state.get('Inventory', {}).values() if isinstance(items, list)
+			for item in items if 'HandleID' in item
+		]
+		self.next_handle_id = max(handle_ids) + 1 if handle_ids else 0
+
+	def start(self):
+		self.listener = gevent.socket.socket()
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+		self.listener.bind((self.host, self.port))
+		self.listener.listen(128)
+		self.port = self.listener.getsockname()[1]
+		self.group.spawn(self._accept)
+		if self.discovery:
+			self.group.spawn(self._discovery)
+		for rate, method in [
+			(self.hp_rate, self.hp_tick),
+			(self.inventory_rate, self.inventory_change),
+			(self.map_rate, self.map_update),
+		]:
+			if rate:
+				self.group.spawn(self._repeat, rate, method)
+
+	def stop(self):
+		# killing _serve() removes its server from self.servers, so take them first
+		servers = list(self.servers)
+		self.group.kill()
+		for server in servers:
+			server.close()
+		self.listener.close()
+
+	def _accept(self):
+		while True:
+			sock, addr = self.listener.accept()
+			self.log.info("Accepted connection from {}".format(addr))
+			self.group.spawn(self._serve, sock)
+
+	def _serve(self, sock):
+		server = SimulatedServer(self, sock)
+		self.servers.add(server)
+		try:
+			server.wait()
+		except Exception:
+			pass # already logged by the server
+		finally:
+			self.servers.discard(server)
+
+	def _discovery(self):
+		addr = self.host
+		if addr == '0.0.0.0':
+			addr = socket.gethostbyname(socket.gethostname())
+		discover_server = DiscoverServer(addr)
+		try:
+			while True:
+				gevent.socket.wait_read(discover_server.fileno())
+				discover_server.serve_pending()
+		finally:
+			discover_server.close()
+
+	def _repeat(self, rate, method):
+		interval = 1. / rate
+		while True:
+			gevent.sleep(interval)
+			method()
+
+	def broadcast(self, message_type, payload):
+		for server in list(self.servers):
+			server.send(message_type, payload)
+
+	def send_values(self, values, payload=''):
+		"""Send the given values, plus an already-encoded payload, to all peers.
+		This also commits the changes, so new snapshots see them."""
+		values = list(values)
+		if self.stamp:
+			stamp = self.pipdata.root[self.STAMP_KEY]
+			stamp.update(repr(time.time()))
+			values.append(stamp)
+		self.pipdata.commit()
+		self.broadcast(MessageType.DATA_UPDATE, payload + ''.join(value.encode() for value in values))
+
+	def hp_tick(self):
+		player_info = self.pipdata.root['PlayerInfo']
+		hp = player_info['CurrHP']
+		hp.update(max(0., min(player_info['MaxHP'].raw_value, hp.raw_value + random.uniform(-10, 10))))
+		changed = {hp}
+		for value in random.sample(self.numeric_values, min(self.update_size - 1, len(self.numeric_values))):
+			if value not in changed:
+				value.update(value.raw_value + (1 if value.value_type == ValueType.INT_32 else random.uniform(-1, 1)))
+				changed.add(value)
+		self.send_values(changed)
+
+	def inventory_change(self):
+		inventory = self.pipdata.root['Inventory']
+		category = random.choice([category for category in inventory if inventory[category].value_type == ValueType.ARRAY])
+		items = inventory[category]
+		action = random.choice(['count', 'count', 'add', 'remove'])
+		if action == 'count' and items.raw_value:
+			count = random.choice(list(items))['count']
+			count.update(max(1, count.raw_value + random.choice([-1, 1])))
+			self.send_values([count])
+		elif action == 'add' or not items.raw_value:
+			item = synthetic_item(self.next_handle_id)
+			self.next_handle_id += 1
+			self.send_values([], self.pipdata.set_subtree(('Inventory', category, len(items.raw_value)), item))
+		else:
+			remove = random.choice(items.raw_value)
+			items.update(tuple(id for id in items.raw_value if id != remove))
+			# as the game does, forget the removed item's values so they don't build up
+			self.pipdata.prune()
+			self.send_values([items])
+
+	def map_update(self):
+		pixels = bytearray(self.local_map.pixels)
+		for x in range(len(pixels) // 100 + 1):
+			pixels[random.randrange(len(pixels))] = random.randrange(256)
+		self.local_map.pixels = str(pixels)
+		self.broadcast(MessageType.LOCAL_MAP_UPDATE, self.local_map.encode())
@@ -0,0 +1,131 @@
+
+from collections import defaultdict
+import os
+import time
+
+from mrpippy import MessageType
+from mrpippy.common import Histogram
+
+
+# maps MessageType values to their names
+MESSAGE_TYPE_NAMES = {
+	value: name for name, value in vars(MessageType).items()
+	if not name.startswith('_')
+}
+
+
+class ServiceStats(object):
+	"""Counters and histograms for one Service's connection.
+	Cheap enough to always be enabled: each message costs a few dict increments,
+	plus a histogram add for received messages."""
+
+	def __init__(self):
+		# these map message type: count
+		self.messages_sent = defaultdict(lambda: 0)
+		self.bytes_sent = defaultdict(lambda: 0)
+		self.messages_received = defaultdict(lambda: 0)
+		self.bytes_received = defaultdict(lambda: 0)
+		# maps message type: Histogram of time taken to process each received message,
+		# eg. for DATA_UPDATE this is the time to decode and apply it.
+		self.process_time = defaultdict(Histogram)
+		# time between consecutive received messages. If the peer is idle, these are keepalive gaps.
+		self.receive_gaps = Histogram(base=0.01)
+		self.last_received = None
+		self.send_queue_depth = 0
+		self.send_queue_max_depth = 0
+		self.started = time.time()
+
+	def sent(self, message_type, length):
+		self.messages_sent[message_type] += 1
+		self.bytes_sent[message_type] += length
+
+	def received(self, message_type, length):
+		now = time.time()
+		if self.last_received is not None:
+			self.receive_gaps.add(now - self.last_received)
+		self.last_received = now
+		self.messages_received[message_type] += 1
+		self.bytes_received[message_type] += length
+
+	def processed(self, message_type, duration):
+		self.process_time[message_type].add(duration)
+
+	def queued(self, depth):
+		self.send_queue_depth = depth
+		self.send_queue_max_depth = max(self.send_queue_max_depth, depth)
+
+	def as_dict(self):
+		"""Returns a json-serializable dict of all stats. Message types are given by name."""
+		def by_name(counts):
+			return {MESSAGE_TYPE_NAMES.get(message_type, str(message_type)): count for message_type, count in counts.items()}
+		def histogram(hist):
+			return {
+				'count': hist.count,
+				'mean': hist.mean,
+				'p50': hist.percentile(50),
+				'p99': hist.percentile(99),
+			}
+		return {
+			'uptime': time.time() - self.started,
+			'messages_sent': by_name(self.messages_sent),
+			'bytes_sent': by_name(self.bytes_sent),
+			'messages_received': by_name(self.messages_received),
+			'bytes_received': by_name(self.bytes_received),
+			'process_time': by_name({
+				message_type: histogram(hist) for message_type, hist in self.process_time.items()
+			}),
+			'receive_gaps': histogram(self.receive_gaps),
+			'last_received': self.last_received,
+			'send_queue_depth': self.send_queue_depth,
+			'send_queue_max_depth': self.send_queue_max_depth,
+		}
+
+	def prometheus(self, **labels):
+		"""Returns stats in prometheus text exposition format, with the given extra labels on every metric"""
+		lines = []
+		def format_labels(**extra):
+			all_labels = dict(labels, **extra)
+			if not all_labels:
+				return ''
+			return '{{{}}}'.format(','.join(
+				'{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+				for key, value in sorted(all_labels.items())
+			))
+		def metric(name, metric_type, help, samples):
+			lines.append('# HELP {} {}'.format(name, help))
+			lines.append('# TYPE {} {}'.format(name, metric_type))
+			for suffix, sample_labels, value in samples:
+				lines.append('{}{}{} {}'.format(name, suffix, format_labels(**sample_labels), value))
+		def histogram_samples(hist, **extra):
+			cumulative = 0
+			for bound, count in zip(hist.bounds + ['+Inf'], hist.counts):
+				cumulative += count
+				yield '_bucket', dict(extra, le=bound), cumulative
+			yield '_sum', extra, hist.total
+			yield '_count', extra, hist.count
+		def counter_samples(directions):
+			for direction, counts in directions:
+				for message_type, count in sorted(counts.items()):
+					yield '', {'direction': direction, 'type': MESSAGE_TYPE_NAMES.get(message_type, message_type)}, count
+
+		metric('gpippy_messages_total', 'counter', 'Messages by direction and type',
+			counter_samples([('sent', self.messages_sent), ('received', self.messages_received)]))
+		metric('gpippy_bytes_total', 'counter', 'Payload bytes by direction and type',
+			counter_samples([('sent', self.bytes_sent), ('received', self.bytes_received)]))
+		metric('gpippy_process_seconds', 'histogram', 'Time to process received messages by type', [
+			sample
+			for message_type, hist in sorted(self.process_time.items())
+			for sample in histogram_samples(hist, type=MESSAGE_TYPE_NAMES.get(message_type, message_type))
+		])
+		metric('gpippy_receive_gap_seconds', 'histogram', 'Time between received messages',
+			histogram_samples(self.receive_gaps))
+		metric('gpippy_send_queue_depth', 'gauge', 'Messages waiting to be sent', [('', {}, self.send_queue_depth)])
+		metric('gpippy_send_queue_max_depth', 'gauge', 'Most messages ever waiting to be sent', [('', {}, self.send_queue_max_depth)])
+		return '\n'.join(lines) + '\n'
+
+	def write_prometheus(self, path, **labels):
+		"""Atomically write prometheus text format to path, eg. for node_exporter's textfile collector"""
+		tmp_path = '{}.tmp'.format(path)
+		with open(tmp_path, 'w') as f:
+			f.write(self.prometheus(**labels))
+		os.rename(tmp_path, path)
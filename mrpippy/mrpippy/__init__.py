@@ -1,6 +1,11 @@
-from common import Incomplete
+from common import Incomplete, InternTable
 from connection import ClientConnection, ServerConnection, MessageType
-from datavalues import PipDataManager, PipValue, ValueType
+from datavalues import PipDataManager, PipValue, ValueType, ChangeSet, Snapshot
 from discovery import DiscoverServer, discover
 from localmap import LocalMap
-from rpc import RequestType, LocationMarkerType, RPCManager, RPCServer
+from rpc import RequestType, LocationMarkerType, RPCManager, RPCServer, RPCError, RPCTimeout, RPCCancelled, TooManyOutstanding
+from maprelay import MapRelayEncoder, MapRelayDecoder, MissingKeyframe
+from profiler import ChurnProfiler
+from history import HistoryRecorder, TimeSeries
+from export import iter_json, dump
+from sharedstate import SharedStateWriter, SharedStateReader
@@ -1,5 +1,7 @@
 
+from bisect import bisect_left
 import struct
+import sys
 
 
 class Incomplete(Exception):
@@ -32,3 +34,96 @@ def parse_string(data):
 	if '\0' not in data:
 		raise Incomplete("Expected nul byte not found")
 	return data.split('\0', 1)
+
+
+class Histogram(object):
+	"""Counts values (eg. latencies in seconds) into exponentially sized buckets.
+	Bucket i counts values <= bounds[i], the final bucket counts anything larger."""
+
+	def __init__(self, base=0.001, factor=2, buckets=16):
+		self.bounds = [base * factor**i for i in range(buckets)]
+		self.counts = [0] * (buckets + 1)
+		self.count = 0
+		self.total = 0
+
+	def __repr__(self):
+		return "<{cls.__name__} count={self.count} mean={self.mean}>".format(cls=type(self), self=self)
+	__str__ = __repr__
+
+	def add(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+
+	@property
+	def mean(self):
+		if not self.count:
+			return
+		return self.total / float(self.count)
+
+	def percentile(self, p):
+		"""Returns the upper bound of the bucket containing the p-th percentile (0 <= p <= 100),
+		or None if no values have been added. Returns infinity if it falls in the final bucket."""
+		if not self.count:
+			return
+		target = self.count * p / 100.
+		seen = 0
+		for bound, count in zip(self.bounds + [float('inf')], self.counts):
+			seen += count
+			if seen >= target:
+				return bound
+
+
+class InternTable(object):
+	"""Keeps one canonical copy of each string it is given, so that repeated strings
+	(eg. OBJECT keys like 'text' or 'count', or item names) share memory.
+	One table may be shared by many PipDataManagers, eg. for many sessions in one process.
+	Unlike the builtin intern(), it keeps stats and can be bounded and cleared."""
+
+	def __init__(self, max_length=256, max_entries=2**16):
+		"""Strings longer than max_length are never interned, as they are unlikely to repeat.
+		Once the table has max_entries strings, new strings are no longer added,
+		but existing ones are still shared."""
+		self.max_length = max_length
+		self.max_entries = max_entries
+		self.table = {}
+		self.hits = 0
+		self.misses = 0
+		# memory used by duplicate strings that were replaced by the canonical copy
+		self.bytes_saved = 0
+
+	def __repr__(self):
+		return "<{cls.__name__} {entries} entries, {self.bytes_saved} bytes saved>".format(
+			cls=type(self), self=self, entries=len(self.table),
+		)
+	__str__ = __repr__
+
+	def __len__(self):
+		return len(self.table)
+
+	def intern(self, string):
+		"""Returns the canonical copy of string"""
+		canonical = self.table.get(string)
+		if canonical is not None:
+			if canonical is not string:
+				self.hits += 1
+				self.bytes_saved += sys.getsizeof(string)
+			return canonical
+		self.misses += 1
+		if len(string) <= self.max_length and len(self.table) < self.max_entries:
+			self.table[string] = string
+		return string
+
+	def stats(self):
+		"""Returns a json-serializable dict of stats"""
+		return {
+			'entries': len(self.table),
+			'bytes': sum(sys.getsizeof(string) for string in self.table),
+			'hits': self.hits,
+			'misses': self.misses,
+			'bytes_saved': self.bytes_saved,
+		}
+
+	def clear(self):
+		"""Forget all strings, eg. if the table has filled up with ones that are no longer used"""
+		self.table = {}
@@ -48,8 +48,13 @@ class Connection(object):
 		return message_type, payload, data
 
 	def send(self, message_type, payload):
-		"""Send a message on the connection"""
-		self.socket.sendall(self.encode(message_type, payload))
+		"""Send a message on the connection.
+		payload may also be a buffer such as a memoryview, which is sent without being copied."""
+		if isinstance(payload, str):
+			self.socket.sendall(self.encode(message_type, payload))
+		else:
+			self.socket.sendall(pack('IB', len(payload), message_type))
+			self.socket.sendall(payload)
 
 	def recv(self):
 		"""Block until the next message can be parsed, and return (message_type, payload).
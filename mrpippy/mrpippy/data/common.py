@@ -3,10 +3,12 @@ class Data(object):
 	"""Base class for all objects based on gathered data values"""
 
 	def __init__(self, value_or_manager):
-		from mrpippy import PipDataManager
-		if isinstance(value_or_manager, PipDataManager):
+		from mrpippy import PipDataManager, Snapshot
+		if isinstance(value_or_manager, (PipDataManager, Snapshot)):
 			value_or_manager = self.from_manager(value_or_manager)
 		self.root = value_or_manager
+		# maps path: (manager.structure_version, PipValue, [(container id, key, child id)])
+		self._resolved = {}
 
 	def from_manager(self, manager):
 		"""Override with a method that returns this object's root value"""
@@ -19,3 +21,41 @@ class Data(object):
 	@property
 	def manager(self):
 		return self.root.manager
+
+	def resolve(self, *path):
+		"""Return the PipValue at the given path of keys (or ARRAY indexes) from our root.
+		eg. resolve('PlayerInfo', 'CurrHP'). Raises KeyError or IndexError if it doesn't exist.
+		The result is cached, and the cache only needs checking if an OBJECT or ARRAY has
+		since changed, in which case it is only discarded if a binding along the path changed."""
+		cached = self._resolved.get(path)
+		if cached is not None:
+			version, value, chain = cached
+			if version == self.manager.structure_version:
+				return value
+			id_map = self.manager.id_map
+			if id_map.get(value.id) is value and all(
+				container_id in id_map and _lookup(id_map[container_id].raw_value, key) == child_id
+				for container_id, key, child_id in chain
+			):
+				self._resolved[path] = self.manager.structure_version, value, chain
+				return value
+		value = self.root
+		chain = []
+		for key in path:
+			child = value[key]
+			chain.append((value.id, key, child.id))
+			value = child
+		self._resolved[path] = self.manager.structure_version, value, chain
+		return value
+
+	def get(self, *path):
+		"""As resolve(), but returns the dereferenced value, as per PipValue.value"""
+		return self.resolve(*path).value
+
+
+def _lookup(raw_value, key):
+	"""Look up key in an OBJECT or ARRAY raw value, returning None if it isn't present"""
+	try:
+		return raw_value[key]
+	except (KeyError, IndexError, TypeError):
+		return
@@ -24,22 +24,28 @@ EQUIP_STATES = {
 
 class Inventory(Data):
 
+	def __init__(self, value_or_manager):
+		super(Inventory, self).__init__(value_or_manager)
+		# maps item type: {id: Item} as of the last _items(), so the Items (and their
+		# resolved paths) can be reused
+		self._item_cache = {}
+
 	def from_manager(self, manager):
 		return manager.root['Inventory']
 
 	@property
 	def stimpak(self):
 		"""Returns the Item() corresponding to stimpaks, or None"""
-		if not self.root.value['stimpakObjectIDIsValid']:
+		if not self.get('stimpakObjectIDIsValid'):
 			return
-		return Item(self.manager.id_map[self.root.value['stimpakObjectID']])
+		return self._item(self.manager.id_map[self.get('stimpakObjectID')], self._item_cache.get('48', {}))
 
 	@property
 	def radaway(self):
 		"""Returns the Item() corresponding to radaways, or None"""
-		if not self.root.value['radawayObjectIDIsValid']:
+		if not self.get('radawayObjectIDIsValid'):
 			return
-		return Item(self.manager.id_map[self.root.value['radawayObjectID']])
+		return self._item(self.manager.id_map[self.get('radawayObjectID')], self._item_cache.get('48', {}))
 
 	@property
 	def items(self):
@@ -81,11 +87,21 @@ class Inventory(Data):
 	def _items(self, item_type):
 		if item_type not in self.root:
 			return []
-		return [Item(value) for value in self.root[item_type]]
+		cache = self._item_cache.get(item_type, {})
+		items = [self._item(value, cache) for value in self.root[item_type]]
+		self._item_cache[item_type] = {item.root.id: item for item in items}
+		return items
+
+	def _item(self, value, cache):
+		"""Returns the Item for value from cache, or a new one if it isn't there"""
+		item = cache.get(value.id)
+		if item is None or item.root is not value:
+			item = Item(value)
+		return item
 
 	@property
 	def version(self):
-		return self.root.value['Version']
+		return self.get('Version')
 
 	@property
 	def weapon(self):
@@ -111,7 +127,7 @@ class Inventory(Data):
 		return self._find_equip(1)
 
 	def _find_equip(self, state):
-		return [item for item in self.items if item.value['equipState'] == state]
+		return [item for item in self.items if item.get('equipState') == state]
 
 
 class Item(Data):
@@ -233,14 +249,14 @@ class Item(Data):
 
 	@property
 	def name(self):
-		return self.root.value['text']
+		return self.get('text')
 
 	@property
 	def count(self):
-		return self.root.value["count"]
+		return self.get('count')
 
 	def _find_info(self, **criteria):
-		infos = [info for info in self.root.value['itemCardInfoList']
+		infos = [info for info in self.get('itemCardInfoList')
 		         if all(info.get(key) == value for key, value in criteria.items())]
 		if not infos:
 			return
@@ -259,9 +275,9 @@ class Item(Data):
 	def favorite(self):
 		"""Returns whether the item is favorited. Possible values are True, False, or None.
 		None indicates the item is not favoritable."""
-		if not self.root.value['canFavorite']:
+		if not self.get('canFavorite'):
 			return
-		return self.root.value['favorite'] >= 0
+		return self.get('favorite') >= 0
 
 	@property
 	def favorite_slot(self):
@@ -269,24 +285,24 @@ class Item(Data):
 		Otherwise None."""
 		if not self.favorite:
 			return
-		return self.root.value['favorite']
+		return self.get('favorite')
 
 	@property
 	def equipped(self):
 		"""Returned whether the item is equipped. Possible values are True, False or None.
 		None indicates the item is not equippable."""
-		state = self.root.value['equipState']
+		state = self.get('equipState')
 		if state is None:
 			return None
 		return state != 0
 
 	@property
 	def handle_id(self):
-		return self.root.value['HandleID']
+		return self.get('HandleID')
 
 	@property
 	def stack_id(self):
-		return self.root.value['StackID']
+		return self.get('StackID')
 
 	@property
 	def effects(self):
@@ -298,7 +314,7 @@ class Item(Data):
 		We ignore long description items.
 		"""
 		results = defaultdict(lambda: 0)
-		for info in self.root.value['itemCardInfoList']:
+		for info in self.get('itemCardInfoList'):
 			if info.get('showAsPercent'):
 				continue
 			if info.text.startswith('$'):
@@ -318,7 +334,7 @@ class Item(Data):
 		"""
 		results = []
 		long_results = [] # long descriptions always go last
-		for info in self.root.value['itemCardInfoList']:
+		for info in self.get('itemCardInfoList'):
 			if info['text'].startswith('$'):
 				continue
 			if info.get('showAsDescription'):
@@ -345,7 +361,7 @@ class Item(Data):
 		"""
 		if self.name.lower() in self.GRENADE_NAMES:
 			return self.name
-		for info in self.root.value['itemCardInfoList']:
+		for info in self.get('itemCardInfoList'):
 			if info['text'].lower() in self.AMMO_TYPES:
 				return info['text']
 
@@ -13,93 +13,87 @@ class Player(Data):
 	@property
 	def locked(self):
 		"""Indicates you shouldn't try to make changes right now"""
-		status = self.value['Status']
-		return any([
-			status['IsInAutoVanity'],
-			status['IsPlayerDead'],
-			status['IsMenuOpen'],
-			status['IsInVats'],
-			status['IsInVatsPlayback'],
-			status['IsPlayerPipboyLocked'],
-			status['IsPlayerMovementLocked'],
-			status['IsPipboyNotEquipped'],
-			status['IsLoading'],
+		return any(self.get('Status', flag) for flag in [
+			'IsInAutoVanity',
+			'IsPlayerDead',
+			'IsMenuOpen',
+			'IsInVats',
+			'IsInVatsPlayback',
+			'IsPlayerPipboyLocked',
+			'IsPlayerMovementLocked',
+			'IsPipboyNotEquipped',
+			'IsLoading',
 		])
 
 	@property
 	def location(self):
-		map = self.value['Map']
 		# CurrCell is empty when outdoors?
-		return map['CurrCell'] or map['CurrWorldspace']
+		return self.get('Map', 'CurrCell') or self.get('Map', 'CurrWorldspace')
 
 	@property
 	def coordinates(self):
 		"""World coords of player"""
-		player = self.value['Map']['World']['Player']
-		return player['X'], player['Y']
+		return self.get('Map', 'World', 'Player', 'X'), self.get('Map', 'World', 'Player', 'Y')
 
 	@property
 	def limbs(self):
 		"""Returns a dict {body part: condition between 0 and 1}"""
 		parts = {"Head", "RLeg", "RArm", "LLeg", "LArm", "Torso"}
-		stats = self.value['Stats']
-		return {part: stats["{}Condition".format(part)] / 100.0 for part in parts}
+		return {part: self.get('Stats', "{}Condition".format(part)) / 100.0 for part in parts}
 
 	@property
 	def name(self):
-		return self.value['PlayerInfo']['PlayerName']
+		return self.get('PlayerInfo', 'PlayerName')
 
 	@property
 	def hp(self):
-		return self.value['PlayerInfo']['CurrHP']
+		return self.get('PlayerInfo', 'CurrHP')
 
 	@property
 	def maxhp(self):
-		return self.value['PlayerInfo']['MaxHP']
+		return self.get('PlayerInfo', 'MaxHP')
 
 	@property
 	def level(self):
 		"""Note this is a float and includes progress to next level"""
-		playerinfo = self.value['PlayerInfo']
-		return playerinfo['XPLevel'] + playerinfo['XPProgressPct']
+		return self.get('PlayerInfo', 'XPLevel') + self.get('PlayerInfo', 'XPProgressPct')
 
 	@property
 	def weight(self):
-		return self.value['PlayerInfo']['CurrWeight']
+		return self.get('PlayerInfo', 'CurrWeight')
 
 	@property
 	def maxweight(self):
-		return self.value['PlayerInfo']['MaxWeight']
+		return self.get('PlayerInfo', 'MaxWeight')
 
 	@property
 	def hour(self):
-		return self.value['PlayerInfo']['TimeHour']
+		return self.get('PlayerInfo', 'TimeHour')
 
 	@property
 	def time(self):
 		"""Returns the in-game time in unix epoch time.
 		Let's hope they solved the 2038 problem!"""
-		playerinfo = self.value['PlayerInfo']
 		return timegm((
-			2000 + playerinfo['DateYear'],
-			playerinfo['DateMonth'],
-			playerinfo['DateDay'],
+			2000 + self.get('PlayerInfo', 'DateYear'),
+			self.get('PlayerInfo', 'DateMonth'),
+			self.get('PlayerInfo', 'DateDay'),
 			0, 0, 0 # hour, min, sec
-		)) + playerinfo['TimeHour'] * 3600
+		)) + self.get('PlayerInfo', 'TimeHour') * 3600
 
 	@property
 	def perks(self):
 		"""Returns a dict {perk name: rank} of (non-hidden) perks the player has (ie. all ranks are at least 1)"""
 		return {
 			perk['Name']: perk['Rank']
-			for perk in self.value['Perks']
+			for perk in self.get('Perks')
 			if perk['Name'] and perk['Rank']
 		}
 
 	@property
 	def radio(self):
 		"""Currently active radio station. Returns string name, or None."""
-		active = [radio['text'] for radio in self.value['Radio'] if radio['active']]
+		active = [radio['text'] for radio in self.get('Radio') if radio['active']]
 		if not active:
 			return
 		active, = active
@@ -108,14 +102,14 @@ class Player(Data):
 	@property
 	def available_radios(self):
 		"""Returns list of available radio stations by name."""
-		return [radio['text'] for radio in self.value['Radio'] if radio['inRange']]
+		return [radio['text'] for radio in self.get('Radio') if radio['inRange']]
 
 	@property
 	def special(self):
 		"""Returns a tuple of player's S.P.E.C.I.A.L. stats, in order."""
-		return [stat['Value'] for stat in self.value['Special']]
+		return [stat['Value'] for stat in self.get('Special')]
 
 	@property
 	def base_special(self):
 		"""As special, but without temporary modifiers."""
-		return [stat['Value'] - stat['Modifier'] for stat in self.value['Special']]
+		return [stat['Value'] - stat['Modifier'] for stat in self.get('Special')]
@@ -1,7 +1,9 @@
 
-from itertools import count
+from collections import deque
+import struct
+import weakref
 
-from common import pack, unpack, parse_string
+from common import unpack, parse_string
 
 
 class ValueType(object):
@@ -16,6 +18,80 @@ class ValueType(object):
 	OBJECT = 8 
 
 
+# (min, max) values for integer value types
+INT_RANGES = {
+	ValueType.INT_8: (-2**7, 2**7 - 1),
+	ValueType.UINT_8: (0, 2**8 - 1),
+	ValueType.INT_32: (-2**31, 2**31 - 1),
+	ValueType.UINT_32: (0, 2**32 - 1),
+}
+
+
+def infer_type(obj):
+	"""Returns the ValueType to use for python value obj, which may be a dict, list, tuple,
+	string, number or bool. Integers are INT_32 if they fit, otherwise UINT_32."""
+	if isinstance(obj, dict):
+		return ValueType.OBJECT
+	if isinstance(obj, (list, tuple)):
+		return ValueType.ARRAY
+	if isinstance(obj, bool):
+		return ValueType.BOOL
+	if isinstance(obj, (int, long)):
+		for value_type in (ValueType.INT_32, ValueType.UINT_32):
+			low, high = INT_RANGES[value_type]
+			if low <= obj <= high:
+				return value_type
+		raise ValueError("Integer {} is too large for any value type".format(obj))
+	if isinstance(obj, float):
+		return ValueType.FLOAT
+	if isinstance(obj, basestring):
+		return ValueType.STRING
+	raise TypeError("Can't infer a value type for {!r}".format(obj))
+
+
+def fits_type(value_type, obj):
+	"""Whether python value obj can be stored as an existing value of type value_type,
+	eg. an int fits a FLOAT or any integer type whose range includes it."""
+	if value_type == ValueType.OBJECT:
+		return isinstance(obj, dict)
+	if value_type == ValueType.ARRAY:
+		return isinstance(obj, (list, tuple))
+	if value_type == ValueType.BOOL:
+		return isinstance(obj, bool)
+	if isinstance(obj, bool):
+		return False
+	if value_type in INT_RANGES:
+		low, high = INT_RANGES[value_type]
+		return isinstance(obj, (int, long)) and low <= obj <= high
+	if value_type == ValueType.FLOAT:
+		return isinstance(obj, (int, long, float))
+	if value_type == ValueType.STRING:
+		return isinstance(obj, basestring)
+	return False
+
+
+def _primitive(value_type, obj):
+	"""Convert python value obj to the raw value for a primitive of value_type"""
+	if isinstance(obj, unicode):
+		return obj.encode('utf-8')
+	if value_type == ValueType.FLOAT:
+		return float(obj)
+	return obj
+
+
+def child_ids(value_type, value):
+	"""Return the ids referenced by a raw value of given type.
+	For OBJECTs, value may be either a dict {key: id} or an (added, removed) pair
+	as returned by PipValue.decode(), in which case only the added ids are returned."""
+	if value_type == ValueType.ARRAY:
+		return value
+	if value_type == ValueType.OBJECT:
+		if isinstance(value, tuple):
+			value, removed = value
+		return value.values()
+	return ()
+
+
 class PipValue(object):
 	# maps applicable primitive value types to struct letters
 	TYPE_MAP = {
@@ -26,6 +102,15 @@ class PipValue(object):
 		ValueType.UINT_32: 'I',
 		ValueType.FLOAT: 'f',
 	}
+	# precompiled structs for each TYPE_MAP entry
+	STRUCTS = {value_type: struct.Struct('<' + letter) for value_type, letter in TYPE_MAP.items()}
+	# value type and id, which starts every record
+	HEADER = struct.Struct('<BI')
+	# the uint16 lengths of ARRAYs and OBJECT added and removed lists
+	LENGTH = struct.Struct('<H')
+	ID = struct.Struct('<I')
+	# cached result of encode() with no prev_state, or None if it needs encoding
+	_encoded = None
 
 	def __init__(self, manager, value_type, value, id=None):
 		"""Value must match value_type.
@@ -36,9 +121,15 @@ class PipValue(object):
 		self.id = manager.next_id() if id is None else id
 		if self.id in self.manager.id_map:
 			raise ValueError("PipValue with id {} already exists: {}".format(self.id, self.manager.id_map[self.id]))
+		self.manager._touch(self.id)
 		self.manager.id_map[self.id] = self
 		self.value_type = value_type
 		self.raw_value = value
+		if value_type in (ValueType.OBJECT, ValueType.ARRAY):
+			# a new container (eg. the root) can make paths resolvable without any existing one changing
+			self.manager.structure_version += 1
+		for child in child_ids(value_type, value):
+			self.manager.parents[child] = self.id
 
 	def __repr__(self):
 		return "<{cls.__name__} {self.id}={self.raw_value!r}>".format(cls=type(self), self=self)
@@ -55,6 +146,8 @@ class PipValue(object):
 
 	def update(self, value):
 		"""Update this id with a new value as returned from decode()"""
+		self.manager._touch(self.id)
+		self._encoded = None
 		if self.value_type == ValueType.OBJECT:
 			added, removed = value
 			self.raw_value = {key: value_id for key, value_id in self.raw_value.items() if value_id not in removed}
@@ -62,6 +155,10 @@ class PipValue(object):
 			self.raw_value.update(added)
 		else:
 			self.raw_value = value
+		if self.value_type in (ValueType.OBJECT, ValueType.ARRAY):
+			self.manager.structure_version += 1
+			for child in child_ids(self.value_type, value):
+				self.manager.parents[child] = self.id
 
 	def __getitem__(self, item):
 		"""Get the PipValue for a subitem of an ARRAY or OBJECT"""
@@ -77,37 +174,101 @@ class PipValue(object):
 				item = self.manager.id_map[item]
 			yield item
 
+	@property
+	def child_ids(self):
+		"""The ids directly referenced by an ARRAY or OBJECT. Empty for primitive values."""
+		return child_ids(self.value_type, self.raw_value)
+
 	def encode(self, prev_state={}):
 		"""Return the encoded string for a DATA_UPDATE of this object's current state.
 		For OBJECTs, optionally include the previously sent state as OBJECT updates are
-		diffs, not absolute values. This state should be a dict {key: id}"""
-		data = pack('BI', self.value_type, self.id)
-		if self.value_type in self.TYPE_MAP:
-			data += pack(self.TYPE_MAP[self.value_type], self.raw_value)
+		diffs, not absolute values. This state should be a dict {key: id}
+		The result without prev_state is cached until the next update(), so values
+		must not be modified except via update()."""
+		if prev_state:
+			return self._encode(prev_state)
+		if self._encoded is None:
+			self._encoded = self._encode()
+		return self._encoded
+
+	def _encode(self, prev_state={}):
+		if self.value_type in self.STRUCTS:
+			# fast path for the most common case, a single fixed-size value
+			return self.HEADER.pack(self.value_type, self.id) + self.STRUCTS[self.value_type].pack(self.raw_value)
+		data = bytearray(self.encoded_size(prev_state))
+		self.encode_into(data, 0, prev_state)
+		return bytes(data)
+
+	def object_diff(self, prev_state={}):
+		"""For OBJECTs, returns the (added, removed) to send given the previously sent state, as per encode()"""
+		if not prev_state:
+			return self.raw_value, ()
+		removed = [value_id for key, value_id in prev_state.items() if self.raw_value.get(key) != value_id]
+		added = {key: value_id for key, value_id in self.raw_value.items() if prev_state.get(key) != value_id}
+		return added, removed
+
+	def encoded_size(self, prev_state={}):
+		"""Return the length of encode(prev_state), without encoding it"""
+		size = self.HEADER.size
+		if self.value_type in self.STRUCTS:
+			size += self.STRUCTS[self.value_type].size
 		elif self.value_type == ValueType.STRING:
-			data += self.raw_value + '\0'
+			size += len(self.raw_value) + 1
 		elif self.value_type == ValueType.ARRAY:
-			data += pack('H', len(self.raw_value)) + pack(len(self.raw_value) * 'I', *self.raw_value)
+			size += self.LENGTH.size + self.ID.size * len(self.raw_value)
 		elif self.value_type == ValueType.OBJECT:
-			removed = [value_id for key, value_id in prev_state.items()
-			           if self.raw_value.get(key) != value_id]
-			added = {key: value_id for key, value_id in self.raw_value.items()
-			         if prev_state.get(key) != value_id}
-			data += pack('H', len(added))
+			added, removed = self.object_diff(prev_state)
+			size += 2 * self.LENGTH.size + self.ID.size * (len(added) + len(removed))
+			size += sum(len(key) + 1 for key in added)
+		return size
+
+	def encode_into(self, data, offset=0, prev_state={}):
+		"""Write encode(prev_state) into bytearray data at offset, which must have encoded_size() bytes free.
+		Returns the offset just after it."""
+		self.HEADER.pack_into(data, offset, self.value_type, self.id)
+		offset += self.HEADER.size
+		if self.value_type in self.STRUCTS:
+			value_struct = self.STRUCTS[self.value_type]
+			value_struct.pack_into(data, offset, self.raw_value)
+			offset += value_struct.size
+		elif self.value_type == ValueType.STRING:
+			end = offset + len(self.raw_value)
+			data[offset:end] = self.raw_value
+			data[end] = 0
+			offset = end + 1
+		elif self.value_type == ValueType.ARRAY:
+			offset = self._encode_ids(data, offset, self.raw_value)
+		elif self.value_type == ValueType.OBJECT:
+			added, removed = self.object_diff(prev_state)
+			# pack all the added (id, nul-terminated key) pairs at once
+			spec = ['<H']
+			args = [len(added)]
 			for key, value_id in added.items():
-				data += pack('I', value_id) + key + '\0'
-			data += pack('H', len(removed)) + pack(len(removed) * 'I', *removed)
-		return data
+				spec.append('I{}sx'.format(len(key)))
+				args += value_id, key
+			spec = ''.join(spec)
+			struct.pack_into(spec, data, offset, *args)
+			offset = self._encode_ids(data, offset + struct.calcsize(spec), removed)
+		return offset
+
+	def _encode_ids(self, data, offset, ids):
+		"""Write a uint16 length followed by uint32 ids into data at offset, returning the offset after it"""
+		struct.pack_into('<H{}I'.format(len(ids)), data, offset, len(ids), *ids)
+		return offset + self.LENGTH.size + self.ID.size * len(ids)
 
 	@classmethod
-	def decode(cls, value_type, data):
+	def decode(cls, value_type, data, intern=None):
 		"""Decode value from data according to value_type, return (value, remaining data).
 		Note the decoded value for objects is (added, deleted) where added is a list of (key, value_id)
-		and deleted is just a list of value_id."""
+		and deleted is just a list of value_id.
+		If given, intern is called with each STRING value and OBJECT key, and its result used instead,
+		eg. InternTable.intern."""
 		if value_type in cls.TYPE_MAP:
 			value, data = unpack(cls.TYPE_MAP[value_type], data)
 		elif value_type == ValueType.STRING:
 			value, data = parse_string(data)
+			if intern:
+				value = intern(value)
 		elif value_type == ValueType.ARRAY:
 			# array is uint16 length, elements are uint32 ids
 			length, data = unpack('H', data)
@@ -121,6 +282,8 @@ class PipValue(object):
 			for x in range(length):
 				id, data = unpack('I', data)
 				key, data = parse_string(data)
+				if intern:
+					key = intern(key)
 				added[key] = id
 			length, data = unpack('H', data)
 			removed, data = unpack(length * 'I', data, as_tuple=True)
@@ -130,52 +293,377 @@ class PipValue(object):
 		return value, data
 
 
-class PipDataManager(object):
+# marks a value that did not exist
+MISSING = object()
+
+
+class FrozenPipValue(PipValue):
+	"""A PipValue belonging to a Snapshot, which can't be modified"""
+
+	def __init__(self, snapshot, value_type, value, id):
+		self.manager = snapshot
+		self.id = id
+		self.value_type = value_type
+		self.raw_value = value
+
+	def update(self, value):
+		raise TypeError("Can't update {}: it is part of a snapshot".format(self))
+
+
+class SnapshotIdMap(object):
+	"""The read-only equivalent of PipDataManager.id_map for a Snapshot"""
+
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+
+	def __getitem__(self, id):
+		value = self.get(id)
+		if value is None:
+			raise KeyError(id)
+		return value
+
+	def get(self, id, default=None):
+		values = self.snapshot._values
+		if id not in values:
+			old = self.snapshot._lookup(id)
+			values[id] = None if old is MISSING else FrozenPipValue(self.snapshot, old[0], old[1], id)
+		value = values[id]
+		return default if value is None else value
+
+	def __contains__(self, id):
+		return self.get(id) is not None
+
+	def __iter__(self):
+		manager = self.snapshot.manager
+		candidates = set(manager.id_map) | set(manager._undo) | set(manager._history)
+		return (id for id in candidates if id in self)
+
+	def __len__(self):
+		return sum(1 for id in self)
+
+
+class Snapshot(object):
+	"""A read-only view of a PipDataManager as of a particular version. See PipDataManager.snapshot().
+	It can be used in most places a manager can, eg. Player(snapshot), and its values are FrozenPipValues.
+	Call release() (or use it as a context manager) once you're done with it so the manager can stop keeping
+	old values around for it. Otherwise this happens once it is garbage collected."""
+
+	def __init__(self, manager):
+		self.manager = manager
+		self.version = manager.version
+		self.id_map = SnapshotIdMap(self)
+		# caches id: FrozenPipValue or None if it doesn't exist
+		self._values = {}
+
+	def __repr__(self):
+		return "<{cls.__name__} of {self.manager} at version {self.version}>".format(cls=type(self), self=self)
+	__str__ = __repr__
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.release()
+
+	@property
+	def structure_version(self):
+		# we never change, so nothing cached against us ever needs re-checking
+		return 0
+
+	@property
+	def root(self):
+		return self.id_map.get(0)
+
+	def _lookup(self, id):
+		"""Returns (value_type, raw_value) of id as of our version, or MISSING"""
+		manager = self.manager
+		# the first recorded value from our version or later is the one we want, as it didn't change in between
+		for version, old in manager._history.get(id, ()):
+			if version >= self.version:
+				return old
+		# otherwise it hasn't changed since the last commit, except perhaps in the current batch
+		if id in manager._undo:
+			return manager._undo[id]
+		value = manager.id_map.get(id)
+		return MISSING if value is None else (value.value_type, value.raw_value)
+
+	def release(self):
+		"""Stop the manager keeping history for us. The snapshot should not be used afterwards."""
+		self.manager._snapshots.discard(self)
+
+
+class ChangeSet(object):
+	"""Summarizes the changes made by one or more DATA_UPDATEs, as filled in by
+	PipDataManager.decode_and_update(changes=...). Only real changes are recorded, ie. a primitive
+	that is re-sent with the same value does not appear.
+		created: set of ids of newly created values
+		values: dict {id: (old, new)} for primitive values that changed. old is the value before
+		        the first change in this set, or None if the value was created.
+		keys_added, keys_removed: dicts {id: set of keys} for OBJECTs whose keys changed.
+		                          A key that was rebound to a new id appears in both.
+		arrays: set of ids of ARRAYs whose contents changed
+		touched: set of ids of all the above, plus all their ancestors up to the root
+	"""
+
 	def __init__(self):
+		self.created = set()
+		self.values = {}
+		self.keys_added = {}
+		self.keys_removed = {}
+		self.arrays = set()
+		self.touched = set()
+
+	def __repr__(self):
+		return "<{cls.__name__} {created} created, {values} values, {objects} objects, {arrays} arrays, {touched} touched>".format(
+			cls=type(self),
+			created=len(self.created),
+			values=len(self.values),
+			objects=len(set(self.keys_added) | set(self.keys_removed)),
+			arrays=len(self.arrays),
+			touched=len(self.touched),
+		)
+	__str__ = __repr__
+
+	def __nonzero__(self):
+		return bool(self.touched)
+	__bool__ = __nonzero__
+
+	def __contains__(self, id):
+		"""Whether id or anything below it changed"""
+		return id in self.touched
+
+	def value_changed(self, pipvalue, old):
+		"""Record a change to pipvalue, which previously had raw value old"""
+		new = pipvalue.raw_value
+		if pipvalue.value_type == ValueType.OBJECT:
+			added = {key for key, value_id in new.items() if old.get(key) != value_id}
+			removed = {key for key, value_id in old.items() if new.get(key) != value_id}
+			if added:
+				self.keys_added.setdefault(pipvalue.id, set()).update(added)
+			if removed:
+				self.keys_removed.setdefault(pipvalue.id, set()).update(removed)
+			if not (added or removed):
+				return
+		elif pipvalue.value_type == ValueType.ARRAY:
+			if old == new:
+				return
+			self.arrays.add(pipvalue.id)
+		else:
+			if pipvalue.id in self.values:
+				old, _ = self.values[pipvalue.id]
+			elif old == new:
+				return
+			self.values[pipvalue.id] = old, new
+		self.touched.add(pipvalue.id)
+
+	def value_created(self, pipvalue):
+		self.created.add(pipvalue.id)
+		if pipvalue.value_type not in (ValueType.OBJECT, ValueType.ARRAY):
+			self.values[pipvalue.id] = None, pipvalue.raw_value
+		self.touched.add(pipvalue.id)
+
+	def rollup(self, manager):
+		"""Add the ancestors of all changed values to touched.
+		Stops early at any ancestor already known to be touched, so this is O(changes)."""
+		for id in list(self.touched):
+			id = manager.parents.get(id)
+			while id is not None and id not in self.touched:
+				self.touched.add(id)
+				id = manager.parents.get(id)
+
+	def paths(self, manager, ids=None):
+		"""Returns {id: path} for the given ids (default: all touched ids), as per PipDataManager.path_map()
+		but only walking up from each id. Ids that are not reachable from the root are omitted."""
+		if ids is None:
+			ids = self.touched
+		paths = {}
+		for id in ids:
+			path = manager.path(id)
+			if path is not None:
+				paths[id] = path
+		return paths
+
+
+class PipDataManager(object):
+	def __init__(self, interests=None, intern_table=None):
+		"""If interests is given, it should be a collection of root keys (eg. 'PlayerInfo', 'Stats')
+		that you care about. Once the root value is known, any records outside of those subtrees
+		are dropped by decode_and_update() instead of being retained or yielded.
+		Note this means a new record is only kept if its parent's update arrives in the same
+		DATA_UPDATE message, which is how the game sends them.
+		If intern_table is given, it should be an InternTable which is used for all decoded OBJECT keys
+		and STRING values. The same table may be given to many managers."""
 		self.id_map = {}
+		self.interests = None if interests is None else set(interests)
+		self.intern_table = intern_table
+		# set this to a ChurnProfiler to record which ids are being updated
+		self.profiler = None
+		# set this to a HistoryRecorder to record numeric values over time
+		self.history = None
+		# incremented whenever any OBJECT or ARRAY is created or changes which ids it refers to
+		self.structure_version = 0
+		# maps id to the id of the OBJECT or ARRAY that most recently referred to it
+		self.parents = {}
+		# all ids below this are in use, see next_id()
+		self._next_id_hint = 0
+		# number of batches of changes that have been committed, see commit() and snapshot()
+		self.version = 0
+		# maps id: (value_type, raw_value) or MISSING as of the last commit, for ids changed since then
+		self._undo = {}
+		# maps id: [(version, (value_type, raw_value) or MISSING)] giving the value as of the end of
+		# each version, for ids changed after it. Only kept while a snapshot needs it.
+		self._history = {}
+		# (version, ids) in the order they were added to _history, so they can be expired in order
+		self._history_log = deque()
+		self._snapshots = weakref.WeakSet()
+		# cached encoding of the full state, see full_state()
+		self._state = None
+		# the ids in _state in order, and their encoded records
+		self._state_ids = []
+		self._state_records = []
+		# maps id: index in _state_ids
+		self._state_index = {}
+		# maps id: offset of its record in _state, or None if it needs recalculating
+		self._state_offsets = None
+		# structure_version that _state was built at
+		self._state_structure_version = None
+		# ids changed since _state was last brought up to date
+		self._state_dirty = set()
+		# whether _state has been returned to a caller, and so must be copied before being modified
+		self._state_shared = False
 
 	def encode(self, *values, **kwargs):
 		"""Takes a list of PipValues, and encodes them all into one DATA_UPDATE payload.
 		If kwarg recursive=True, also include all PipValues that are children of the given values.
 		A new connection should always start with manager.encode_all(manager.root, recursive=True).
 		"""
+		return self.encode_buffer(*values, **kwargs).tobytes()
+
+	def encode_buffer(self, *values, **kwargs):
+		"""As encode(), but returns a memoryview of the payload, which can be sent without being copied.
+		Each value is encoded directly into one buffer allocated to the exact size up front."""
 		recursive = kwargs.pop('recursive', False)
 		if kwargs:
 			raise ValueError("Unexpected kwargs: {}".format(kwargs))
-
 		if recursive:
-			original_values = values
-			values = []
-			def add(value):
-				# if already present, move to front
-				if value in values:
-					values.remove(value)
-				values.insert(0, value)
-				if value.value_type == ValueType.ARRAY:
-					ids = value.raw_value
-				elif value.value_type == ValueType.OBJECT:
-					ids = value.raw_value.values()
-				else:
-					return
-				for id in ids:
-					add(self.id_map[id])
-			for value in original_values:
-				add(value)
+			values = self.descendants(*values)
+		data = bytearray(sum(value.encoded_size() for value in values))
+		offset = 0
+		for value in values:
+			offset = value.encode_into(data, offset)
+		return memoryview(data)
+
+	def full_state(self):
+		"""Returns a memoryview of encode(root, recursive=True), as sent to a new peer.
+		The result is cached, and values that have changed since it was last built are patched into it
+		if their record is the same size (eg. all numbers and bools). Otherwise, it is rebuilt by joining
+		each value's cached encoding, so only changed values are re-encoded either way. If any OBJECT or ARRAY
+		has changed, the tree must also be walked again to find the order of the records.
+		The returned buffer is never modified afterwards, so it is safe to keep sending it."""
+		if self.root is None:
+			raise ValueError("Can't encode full state before the root exists")
+		if self._state is None or self._state_structure_version != self.structure_version or not self._patch_state():
+			self._build_state()
+		self._state_shared = True
+		return memoryview(self._state)
+
+	def _build_state(self):
+		values = self.descendants(self.root)
+		self._state_ids = [value.id for value in values]
+		self._state_records = [value.encode() for value in values]
+		self._state_index = {id: index for index, id in enumerate(self._state_ids)}
+		self._state_offsets = None
+		self._state = bytearray().join(self._state_records)
+		self._state_structure_version = self.structure_version
+		self._state_dirty = set()
+		self._state_shared = False
 
-		return ''.join(value.encode() for value in values)
+	def _patch_state(self):
+		"""Apply changed values to _state. If all the changed records are the same size they are
+		overwritten in place, otherwise the records are joined into a new buffer.
+		Returns False if the state must be rebuilt instead."""
+		patches = []
+		for id in self._state_dirty:
+			if id not in self._state_index:
+				continue # not reachable from the root, so not part of the state
+			if id not in self.id_map:
+				return False
+			patches.append((id, self.id_map[id].encode()))
+		self._state_dirty = set()
+		resized = False
+		for id, record in patches:
+			index = self._state_index[id]
+			resized = resized or len(record) != len(self._state_records[index])
+			self._state_records[index] = record
+		if resized:
+			self._state = bytearray().join(self._state_records)
+			self._state_shared = False
+			self._state_offsets = None
+			return True
+		if not patches:
+			return True
+		if self._state_offsets is None:
+			self._state_offsets = {}
+			offset = 0
+			for id, record in zip(self._state_ids, self._state_records):
+				self._state_offsets[id] = offset
+				offset += len(record)
+		if self._state_shared:
+			self._state = bytearray(self._state)
+			self._state_shared = False
+		for id, record in patches:
+			offset = self._state_offsets[id]
+			self._state[offset:offset + len(record)] = record
+		return True
 
-	def decode(self, data):
-		"""Decode a DATA_UPDATE message, yielding (id, value_type, value) updates."""
+	def descendants(self, *values):
+		"""Returns a list of the given values and all their children, recursively, with each value
+		only once and children before their parents."""
+		result = []
+		seen = set()
+		# (value, whether its children have already been added)
+		stack = [(value, False) for value in reversed(values)]
+		while stack:
+			value, expanded = stack.pop()
+			if expanded:
+				result.append(value)
+				continue
+			if value.id in seen:
+				continue
+			seen.add(value.id)
+			stack.append((value, True))
+			stack += [
+				(self.id_map[id], False) for id in reversed(list(value.child_ids))
+				if id not in seen
+			]
+		return result
+
+	def decode(self, data, sizes=False):
+		"""Decode a DATA_UPDATE message, yielding (id, value_type, value) updates.
+		If sizes=True, yield (id, value_type, value, encoded length) instead."""
+		intern = None if self.intern_table is None else self.intern_table.intern
 		while data:
+			length = len(data)
 			(value_type, id), data = unpack('BI', data)
-			value, data = PipValue.decode(value_type, data)
-			yield id, value_type, value
+			value, data = PipValue.decode(value_type, data, intern)
+			if sizes:
+				yield id, value_type, value, length - len(data)
+			else:
+				yield id, value_type, value
 
-	def decode_and_update(self, data):
+	def decode_and_update(self, data, changes=None):
 		"""Decode a DATA_UPDATE message, create or update the pip values, and yield them.
-		To simply update all values at once, use list(decode_and_update()).
-		To update a value manually, you should instead manipulate the PipValue directly."""
-		for id, value_type, value in self.decode(data):
+		To simply update all values at once, use list(decode_and_update()), or see apply().
+		To update a value manually, you should instead manipulate the PipValue directly.
+		If changes is given, it should be a ChangeSet which is filled in with what changed.
+		Its touched ancestors are only complete once the generator is exhausted."""
+		for pipvalue in self._apply(self._updates(data), changes):
+			yield pipvalue
+
+	def _apply(self, updates, changes):
+		"""Generator that does the work of decode_and_update() for already-decoded updates"""
+		had_root = self.root is not None
+		for id, value_type, value in updates:
 			if id in self.id_map:
 				pipvalue = self.id_map[id]
 				if pipvalue.value_type != value_type:
@@ -183,20 +671,348 @@ class PipDataManager(object):
 						value_type=value_type,
 						pipvalue=pipvalue,
 					))
+				old = pipvalue.raw_value
 				pipvalue.update(value)
+				if changes is not None:
+					changes.value_changed(pipvalue, old)
 			else:
 				if value_type == ValueType.OBJECT:
 					value, removed = value
 					if removed:
 						raise ValueError("Got non-empty removed list for new id {}".format(id))
 				pipvalue = PipValue(self, value_type, value, id)
+				if changes is not None:
+					changes.value_created(pipvalue)
+			yield pipvalue
+		if self.interests is not None and not had_root and self.root is not None:
+			# anything we kept before we knew the root may be uninteresting
+			self.prune()
+		if changes is not None:
+			# new values' parents may have come later in the message, so only do this at the end
+			changes.rollup(self)
+		if self.history is not None:
+			self.history.sample(self)
+		self.commit()
+
+	def _updates(self, data):
+		"""As decode(), but also profiles and filters by interests if enabled"""
+		if self.profiler is None:
+			updates = self.decode(data)
+		else:
+			updates = self.profiler.record(self.decode(data, sizes=True))
+		if self.interests is not None:
+			updates = self.filter_interests(list(updates))
+		return updates
+
+	def reconcile(self, data, changes=None):
+		"""Takes a DATA_UPDATE message containing the complete state, as sent on connecting,
+		and makes our state match it. Unlike decode_and_update(), only values that are new or changed
+		are updated and yielded (and recorded in changes, if given), and values that are no longer
+		reachable from the root are removed. This is for reconnecting to the same game without
+		everything downstream seeing the whole state as new.
+		Values are matched by id. If the game has since re-used ids for different values,
+		the result is still correct, but more values will be seen as changed.
+		If data doesn't include the root, it can't be the complete state, so nothing is removed
+		and it is applied as per decode_and_update() instead."""
+		updates = list(self._updates(data))
+		if not any(id == 0 for id, value_type, value in updates):
+			for pipvalue in self._apply(updates, changes):
+				yield pipvalue
+			return
+		for id, value_type, value in updates:
+			pipvalue = self.id_map.get(id)
+			if pipvalue is not None and pipvalue.value_type != value_type:
+				# id has been re-used for a different type of value, so replace it
+				self._touch(id)
+				del self.id_map[id]
+				self.structure_version += 1
+				pipvalue = None
+			if pipvalue is None:
+				if value_type == ValueType.OBJECT:
+					value, removed = value
+				pipvalue = PipValue(self, value_type, value, id)
+				if changes is not None:
+					changes.value_created(pipvalue)
+				yield pipvalue
+				continue
+			old = pipvalue.raw_value
+			if value_type == ValueType.OBJECT:
+				# a full state gives each OBJECT's complete contents, turn it into a diff
+				value, removed = value
+				if value == old:
+					continue
+				removed = [value_id for key, value_id in old.items() if value.get(key) != value_id]
+				value = {key: value_id for key, value_id in value.items() if old.get(key) != value_id}, removed
+			elif value == old:
+				continue
+			pipvalue.update(value)
+			if changes is not None:
+				changes.value_changed(pipvalue, old)
 			yield pipvalue
+		self.prune()
+		if changes is not None:
+			changes.rollup(self)
+		if self.history is not None:
+			self.history.sample(self)
+		self.commit()
+
+	def apply(self, data):
+		"""Decode and apply a DATA_UPDATE message, returning a ChangeSet of what changed"""
+		changes = ChangeSet()
+		for pipvalue in self.decode_and_update(data, changes):
+			pass
+		return changes
+
+	def filter_interests(self, updates):
+		"""Takes a list of (id, value_type, value) updates as returned by decode(),
+		and returns only those that fall within self.interests.
+		The root's update has any uninteresting keys removed.
+		If the root is not yet known, all updates are kept."""
+		by_id = {id: (value_type, value) for id, value_type, value in updates}
+		if self.root is None and 0 not in by_id:
+			return updates
+		if 0 in by_id and by_id[0][0] == ValueType.OBJECT:
+			added, removed = by_id[0][1]
+			added = {key: value_id for key, value_id in added.items() if key in self.interests}
+			by_id[0] = ValueType.OBJECT, (added, removed)
+		# Existing records are already known to be interesting, as is the root.
+		# New records are interesting if an interesting record in this update refers to them.
+		kept = set()
+		to_check = [id for id in by_id if id == 0 or id in self.id_map]
+		while to_check:
+			id = to_check.pop()
+			if id in kept:
+				continue
+			kept.add(id)
+			to_check += [
+				child for child in child_ids(*by_id[id])
+				if child in by_id and child not in self.id_map
+			]
+		return [
+			(id, value_type, by_id[0][1] if id == 0 else value)
+			for id, value_type, value in updates if id in kept
+		]
+
+	def prune(self):
+		"""Remove all values which are not reachable from the root.
+		Does nothing if the root is not yet known."""
+		if self.root is None:
+			return
+		reachable = set()
+		to_check = [0]
+		while to_check:
+			id = to_check.pop()
+			if id in reachable or id not in self.id_map:
+				continue
+			reachable.add(id)
+			to_check += self.id_map[id].child_ids
+		unreachable = set(self.id_map) - reachable
+		for id in unreachable:
+			self._touch(id)
+			del self.id_map[id]
+			self.parents.pop(id, None)
+			self._next_id_hint = min(self._next_id_hint, id)
+		if unreachable:
+			self.structure_version += 1
+
+	def _touch(self, id):
+		"""Must be called before id is created, changed or deleted, so snapshots can still see the old value"""
+		if id not in self._undo:
+			value = self.id_map.get(id)
+			self._undo[id] = MISSING if value is None else (value.value_type, value.raw_value)
+		if self._state is not None:
+			self._state_dirty.add(id)
+
+	def commit(self):
+		"""Mark the end of a batch of changes, so that new snapshots will see them.
+		This is done automatically by decode_and_update(), reconcile(), from_value() and set_subtree(),
+		and by RPCServer.pop_updates(). If you change values directly, you should call this
+		once the data is consistent again."""
+		if self._snapshots:
+			if self._undo:
+				for id, old in self._undo.items():
+					self._history.setdefault(id, []).append((self.version, old))
+				self._history_log.append((self.version, list(self._undo)))
+			# history from before the oldest snapshot is no longer needed
+			oldest = min(snapshot.version for snapshot in self._snapshots)
+			while self._history_log and self._history_log[0][0] < oldest:
+				version, ids = self._history_log.popleft()
+				for id in ids:
+					entries = self._history[id]
+					entries.pop(0)
+					if not entries:
+						del self._history[id]
+		else:
+			self._history.clear()
+			self._history_log.clear()
+		self._undo = {}
+		self.version += 1
+
+	def snapshot(self):
+		"""Returns a read-only Snapshot of the data as of the last commit(), ie. not including
+		any partially-applied DATA_UPDATE. Taking a snapshot is O(1), and it stays consistent
+		while further updates are applied, at the cost of keeping the old values of anything
+		that changes for as long as it is alive."""
+		snapshot = Snapshot(self)
+		self._snapshots.add(snapshot)
+		return snapshot
+
+	def path_map(self):
+		"""Returns a dict {id: path} for all values reachable from the root,
+		where path is a tuple of OBJECT keys and ARRAY indexes from the root."""
+		paths = {}
+		to_check = [(0, ())]
+		while to_check:
+			id, path = to_check.pop()
+			if id in paths or id not in self.id_map:
+				continue
+			paths[id] = path
+			value = self.id_map[id]
+			if value.value_type == ValueType.OBJECT:
+				to_check += [(child, path + (key,)) for key, child in value.raw_value.items()]
+			elif value.value_type == ValueType.ARRAY:
+				to_check += [(child, path + (index,)) for index, child in enumerate(value.raw_value)]
+		return paths
+
+	def path(self, id):
+		"""Returns the path to id as per path_map(), by walking up from it.
+		Returns None if id is not reachable from the root."""
+		path = []
+		while id != 0:
+			parent = self.parents.get(id)
+			if parent is None or parent not in self.id_map:
+				return None
+			parent_value = self.id_map[parent]
+			if parent_value.value_type == ValueType.OBJECT:
+				keys = [key for key, child in parent_value.raw_value.items() if child == id]
+			else:
+				keys = [index for index, child in enumerate(parent_value.raw_value) if child == id]
+			if not keys:
+				return None # parent no longer refers to it
+			path.append(keys[0])
+			id = parent
+		return tuple(reversed(path))
 
 	def next_id(self):
 		"""Get next lowest available id number"""
-		next_id = (id for id in count() if id not in self.id_map).next()
-		if next_id >= 2**16:
+		next_id = self._next_id_hint
+		while next_id in self.id_map:
+			next_id += 1
+		if next_id >= 2**32:
 			raise ValueError("Out of ids")
+		self._next_id_hint = next_id + 1
+		return next_id
+
+	@classmethod
+	def from_value(cls, obj, **kwargs):
+		"""Returns a new manager whose root is built from obj, which should be a dict of nested
+		python data (dicts, lists, strings, numbers and bools), eg. as loaded from a JSON dump.
+		Value types are chosen as per infer_type(), and the root gets id 0.
+		Other kwargs are passed to the manager's constructor."""
+		if not isinstance(obj, dict):
+			raise TypeError("Root must be a dict, not {!r}".format(obj))
+		manager = cls(**kwargs)
+		# nobody has the previous (empty) state, so don't bother encoding the changes
+		manager._build(PipValue(manager, ValueType.OBJECT, {}, 0), obj, None)
+		manager.commit()
+		return manager
+
+	def set_subtree(self, path, obj):
+		"""Set the value at path (a sequence of OBJECT keys and ARRAY indexes from the root) to obj,
+		which is nested python data as per from_value(). The last key may be a new key of an OBJECT,
+		or one past the end of an ARRAY to append to it.
+		Existing values are kept and updated in place where their type allows, so only values that actually
+		change are touched, and OBJECT keys not present in obj are removed. New values are allocated with next_id().
+		Returns a DATA_UPDATE payload containing only the changes, suitable for sending to peers
+		that had the previous state."""
+		records = []
+		if not path:
+			if not isinstance(obj, dict):
+				raise TypeError("Root must be a dict, not {!r}".format(obj))
+			root = self.root
+			if root is None:
+				root = PipValue(self, ValueType.OBJECT, {}, 0)
+			self._build(root, obj, records)
+		else:
+			parent = self.root
+			if parent is None:
+				raise KeyError("Can't set {!r} before the root exists".format(path))
+			for key in path[:-1]:
+				parent = parent[key]
+			key = path[-1]
+			if parent.value_type == ValueType.OBJECT:
+				existing_id = parent.raw_value.get(key)
+			elif parent.value_type == ValueType.ARRAY:
+				if key > len(parent.raw_value):
+					raise IndexError("Can't set index {} of {} entry ARRAY {}".format(key, len(parent.raw_value), parent))
+				existing_id = parent.raw_value[key] if key < len(parent.raw_value) else None
+			else:
+				raise TypeError("Can't set {!r} in {}, it is not an OBJECT or ARRAY".format(key, parent))
+			existing = None if existing_id is None else self.id_map[existing_id]
+			new_id = self._build(existing, obj, records)
+			if existing is None or new_id != existing.id:
+				prev_state = parent.raw_value
+				if parent.value_type == ValueType.OBJECT:
+					parent.update(({key: new_id}, [existing.id] if existing else []))
+				elif key == len(parent.raw_value):
+					parent.update(parent.raw_value + (new_id,))
+				else:
+					parent.update(parent.raw_value[:key] + (new_id,) + parent.raw_value[key + 1:])
+				records.append(parent.encode(prev_state) if parent.value_type == ValueType.OBJECT else parent.encode())
+		self.commit()
+		return ''.join(records)
+
+	def _build(self, existing, obj, records):
+		"""Make existing (a PipValue or None) have value obj, or create a new value if it can't.
+		Appends encoded records of anything that changed to records, children before parents,
+		unless records is None. Returns the resulting value's id."""
+		if existing is None or not fits_type(existing.value_type, obj):
+			return self._create(obj, records)
+		if existing.value_type == ValueType.OBJECT:
+			old = existing.raw_value
+			value = {}
+			for key, child in obj.items():
+				if isinstance(key, unicode):
+					key = key.encode('utf-8')
+				value[key] = self._build(self.id_map[old[key]] if key in old else None, child, records)
+			if value == old:
+				return existing.id
+			removed = [value_id for key, value_id in old.items() if value.get(key) != value_id]
+			added = {key: value_id for key, value_id in value.items() if old.get(key) != value_id}
+			existing.update((added, removed))
+			if records is not None:
+				records.append(existing.encode(old))
+			return existing.id
+		if existing.value_type == ValueType.ARRAY:
+			old = existing.raw_value
+			value = tuple(
+				self._build(self.id_map[old[index]] if index < len(old) else None, child, records)
+				for index, child in enumerate(obj)
+			)
+		else:
+			value = _primitive(existing.value_type, obj)
+		if value != existing.raw_value:
+			existing.update(value)
+			if records is not None:
+				records.append(existing.encode())
+		return existing.id
+
+	def _create(self, obj, records):
+		"""As _build(), but always creates new values"""
+		value_type = infer_type(obj)
+		if value_type == ValueType.OBJECT:
+			value = {
+				key.encode('utf-8') if isinstance(key, unicode) else key: self._create(child, records)
+				for key, child in obj.items()
+			}
+		elif value_type == ValueType.ARRAY:
+			value = tuple(self._create(child, records) for child in obj)
+		else:
+			value = _primitive(value_type, obj)
+		pipvalue = PipValue(self, value_type, value, self.next_id())
+		if records is not None:
+			records.append(pipvalue.encode())
+		return pipvalue.id
 
 	@property
 	def root(self):
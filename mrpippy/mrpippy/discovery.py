@@ -1,32 +1,92 @@
 
+from collections import OrderedDict
 from contextlib import closing
 from select import select
+import errno
 import json
+import os
 import socket
+import struct
 import time
 
+try:
+	import netifaces
+except ImportError:
+	netifaces = None
 
-def discover(timeout=1, repeats=5, port=28000, allow_busy=False):
+
+# How long discover() results are cached for by default, in seconds
+CACHE_TTL = 30
+
+# maps (port, allow_busy) to (expiry time, complete, results)
+_cache = {}
+
+
+def broadcast_addresses():
+	"""Returns the set of broadcast addresses of all local IPv4 interfaces,
+	always including 255.255.255.255. Uses netifaces if available,
+	otherwise falls back to querying the interfaces directly (linux only)."""
+	addrs = {'255.255.255.255'}
+	if netifaces is not None:
+		for interface in netifaces.interfaces():
+			for addr in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+				if addr.get('broadcast'):
+					addrs.add(addr['broadcast'])
+	elif os.path.exists('/proc/net/dev'):
+		import fcntl
+		SIOCGIFBRDADDR = 0x8919
+		with open('/proc/net/dev') as f:
+			# first two lines are headers
+			interfaces = [line.split(':', 1)[0].strip() for line in f.readlines()[2:]]
+		with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+			for interface in interfaces:
+				try:
+					result = fcntl.ioctl(sock.fileno(), SIOCGIFBRDADDR, struct.pack('256s', interface[:15]))
+				except IOError:
+					continue # no ipv4 address
+				addrs.add(socket.inet_ntoa(result[20:24]))
+	addrs.discard('0.0.0.0')
+	return addrs
+
+
+def discover(timeout=1, repeats=5, port=28000, allow_busy=False, first=False, cache_ttl=CACHE_TTL):
 	"""Uses UDP broadcast to find pip boy app hosts on the local network.
 	Returns a set of (ip, machine_type).
 	if allow_busy=True, also include replies that indicated server was present but busy.
 	timeout is how long to wait for responses.
 	repeats is how many broadcast packets to send. This makes the message (and replies) more likely
-	to make it through despite packet loss."""
+	to make it through despite packet loss.
+	The broadcast is sent on every local interface at once.
+	If first=True, return as soon as any host is found instead of waiting for the full timeout.
+	Non-empty results are cached for cache_ttl seconds, and repeated calls within that time
+	return the cached results without sending anything. Set cache_ttl=0 to disable the cache.
+	Results found with first=True may be incomplete, so they are only re-used for other first=True calls."""
+	key = port, allow_busy
+	if cache_ttl and key in _cache:
+		expiry, complete, results = _cache[key]
+		if time.time() < expiry and (complete or first):
+			return set(results)
+
 	with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)) as sock:
 		sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+		request = json.dumps({'cmd': 'autodiscover'})
+		addrs = broadcast_addresses()
 		for x in range(repeats):
-			sock.sendto(json.dumps({'cmd': 'autodiscover'}), ('255.255.255.255', 28000))
+			for addr in addrs:
+				try:
+					sock.sendto(request, (addr, port))
+				except socket.error:
+					pass # interface may be down or unroutable, keep trying the others
 		results = set()
 		start = time.time()
-		while True:
+		while not (first and results):
 			time_left = start + timeout - time.time()
 			if time_left <= 0:
 				break
 			r, w, x = select([sock], [], [], time_left)
 			if r:
 				assert r == [sock]
-				message = sock.recvfrom(1024)
+				message, addr = sock.recvfrom(1024)
 				try:
 					message = json.loads(message)
 				except (ValueError, UnicodeDecodeError):
@@ -38,34 +98,142 @@ def discover(timeout=1, repeats=5, port=28000, allow_busy=False):
 				if message['IsBusy'] and not allow_busy:
 					continue # server is busy, ignore it
 				results.add((message['addr'], message['MachineType']))
+
+	if cache_ttl and results:
+		_cache[key] = time.time() + cache_ttl, not first, set(results)
 	return results
 
 
+def clear_cache():
+	"""Forget any cached discover() results, eg. because connecting to them failed."""
+	_cache.clear()
+
+
 class DiscoverServer(object):
+	"""Answers discovery requests from apps on the local network.
+	The socket is non-blocking. To integrate with an event loop, wait for fileno() to be readable
+	then call serve_pending(). Alternately, serve_forever() runs until stop() is called.
+	Replies are rate limited per source address, so a flood of requests can't monopolize us."""
+	# the request as sent by discover() and the official app, which we can recognise without parsing
+	REQUEST = json.dumps({'cmd': 'autodiscover'})
+	# requests per second we will answer from any one source, and how many we allow in a burst
+	RATE_LIMIT = 5
+	RATE_BURST = 10
+	# max number of sources to track before we start forgetting idle ones
+	MAX_SOURCES = 4096
+	# how often serve_forever() checks whether it has been stopped
+	POLL_INTERVAL = 1
+
 	def __init__(self, addr, machine_type='PC', port=28000, busy=False):
 		"""addr is the tcp addr to advertise connections for"""
-		self.addr = addr
-		self.machine_type = machine_type
-		self.busy = busy
+		self._addr = addr
+		self._machine_type = machine_type
+		self._busy = busy
+		self._response = None
+		self.buckets = OrderedDict() # maps source ip to (tokens, time last updated), least recently updated first
+		self.running = False
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+		self.socket.setblocking(False)
 		self.socket.bind(('255.255.255.255', port))
 
-	def serve_one(self):
-		msg, addr = self.socket.recvfrom(1024)
+	def _response_property(name):
+		"""Generates a property which resets the cached response when set"""
+		attr = '_{}'.format(name)
+		def get(self):
+			return getattr(self, attr)
+		def set(self, value):
+			setattr(self, attr, value)
+			self._response = None
+		return property(get, set)
+
+	addr = _response_property('addr')
+	machine_type = _response_property('machine_type')
+	busy = _response_property('busy')
+	del _response_property
+
+	@property
+	def response(self):
+		"""The encoded reply, which is only rebuilt when addr, machine_type or busy change"""
+		if self._response is None:
+			self._response = json.dumps({
+				'addr': self.addr,
+				'MachineType': self.machine_type,
+				'IsBusy': self.busy,
+			})
+		return self._response
+
+	def fileno(self):
+		return self.socket.fileno()
+
+	def close(self):
+		self.stop()
+		self.socket.close()
+
+	def allow(self, source):
+		"""Token bucket rate limit for given source ip. Returns whether a request should be answered."""
+		now = time.time()
+		if source not in self.buckets and len(self.buckets) >= self.MAX_SOURCES:
+			# forget the least recently seen source if it would have a full bucket anyway,
+			# otherwise we're being flooded and new sources have to wait
+			oldest = next(iter(self.buckets))
+			tokens, updated = self.buckets[oldest]
+			if now - updated < float(self.RATE_BURST) / self.RATE_LIMIT:
+				return False
+			del self.buckets[oldest]
+		tokens, updated = self.buckets.pop(source, (self.RATE_BURST, now))
+		tokens = min(self.RATE_BURST, tokens + (now - updated) * self.RATE_LIMIT)
+		if tokens < 1:
+			self.buckets[source] = tokens, now
+			return False
+		self.buckets[source] = tokens - 1, now
+		return True
+
+	def is_request(self, msg):
+		if msg == self.REQUEST:
+			return True
 		try:
 			msg = json.loads(msg)
 		except Exception:
-			return # malformed msg
-		if msg != {'cmd': 'autodiscover'}:
-			return # ignore bad msg
-		response = {
-			'addr': self.addr,
-			'MachineType': self.machine_type,
-			'IsBusy': self.busy,
-		}
-		self.socket.sendto(json.dumps(response), addr)
+			return False # malformed msg
+		return msg == {'cmd': 'autodiscover'}
+
+	def serve_one(self):
+		"""Handle one incoming packet without blocking.
+		Returns False if there was nothing to handle, otherwise True."""
+		try:
+			msg, addr = self.socket.recvfrom(1024)
+		except socket.error as ex:
+			if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return False
+			raise
+		# rate limit before parsing, so junk floods are cheap too
+		if self.allow(addr[0]) and self.is_request(msg):
+			try:
+				self.socket.sendto(self.response, addr)
+			except socket.error as ex:
+				if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					raise
+				# send buffer is full, drop the reply. the client will retry.
+		return True
+
+	def serve_pending(self, limit=None):
+		"""Handle incoming packets until none are left or limit is reached, without blocking.
+		Returns how many were handled."""
+		handled = 0
+		while limit is None or handled < limit:
+			if not self.serve_one():
+				break
+			handled += 1
+		return handled
 
 	def serve_forever(self):
-		while True:
-			self.serve_one()
+		"""Serve requests until stop() is called"""
+		self.running = True
+		while self.running:
+			r, w, x = select([self.socket], [], [], self.POLL_INTERVAL)
+			if r:
+				self.serve_pending()
+
+	def stop(self):
+		self.running = False
@@ -0,0 +1,105 @@
+
+import json
+
+from datavalues import PipDataManager, ValueType
+
+
+def path_tree(paths):
+	"""Convert a list of paths (tuples of keys and indexes) into a nested dict {key: subtree},
+	where a subtree of None means include everything below that point."""
+	tree = {}
+	for path in paths:
+		if not path:
+			return None # everything is included
+		node = tree
+		for key in path[:-1]:
+			if key in node and node[key] is None:
+				break # already including everything here
+			node = node.setdefault(key, {})
+		else:
+			node[path[-1]] = None
+	return tree
+
+
+def _container(value, tree, indent, depth):
+	"""Generator of the parts of an OBJECT or ARRAY. Parts are either strings,
+	or (child PipValue, child tree, child depth) to be expanded in their place."""
+	if value.value_type == ValueType.OBJECT:
+		start, end = '{', '}'
+		entries = ((key, json.dumps(key) + ': ', child) for key, child in value.raw_value.items())
+	else:
+		start, end = '[', ']'
+		entries = ((index, '', child) for index, child in enumerate(value.raw_value))
+	if indent is None:
+		separator, newline, closing_newline = ', ', '', ''
+	else:
+		separator = ','
+		newline = '\n' + ' ' * (indent * (depth + 1))
+		closing_newline = '\n' + ' ' * (indent * depth)
+	yield start
+	first = True
+	for key, prefix, child in entries:
+		if tree is not None and key not in tree:
+			continue
+		yield ('' if first else separator) + newline + prefix
+		yield value.manager.id_map[child], None if tree is None else tree[key], depth + 1
+		first = False
+	yield end if first else closing_newline + end
+
+
+def iter_json(manager, value=None, paths=None, indent=None, chunk_size=64 * 1024):
+	"""Encodes value (by default, the root) as JSON directly from the manager's values,
+	yielding chunks of roughly chunk_size.
+	This avoids building the full python structure as value.value would, so the extra memory used
+	is only the chunk plus a little per level of nesting. Callers may do other work between chunks.
+	If paths is given, only those paths (tuples of keys and indexes relative to value) are included,
+	along with the containers leading to them.
+	indent works as for json.dumps.
+	manager may be a PipDataManager or a Snapshot. For a PipDataManager, we export from a snapshot()
+	of it, so that changes made between chunks (eg. by other greenlets) can't leave the output
+	inconsistent or remove values out from under us. The snapshot is as of the last commit()."""
+	snapshot = manager.snapshot() if isinstance(manager, PipDataManager) else None
+	if snapshot is not None:
+		manager = snapshot
+		if value is not None:
+			value = snapshot.id_map[value.id]
+	try:
+		if value is None:
+			value = manager.root
+		tree = None if paths is None else path_tree(paths)
+		stack = [iter([(value, tree, 0)])]
+		parts = []
+		size = 0
+		while stack:
+			try:
+				part = next(stack[-1])
+			except StopIteration:
+				stack.pop()
+				continue
+			if not isinstance(part, basestring):
+				value, tree, depth = part
+				if value.value_type in (ValueType.OBJECT, ValueType.ARRAY):
+					stack.append(_container(value, tree, indent, depth))
+					continue
+				part = json.dumps(value.raw_value)
+			parts.append(part)
+			size += len(part)
+			if size >= chunk_size:
+				yield ''.join(parts)
+				parts = []
+				size = 0
+		if parts:
+			yield ''.join(parts)
+	finally:
+		if snapshot is not None:
+			snapshot.release()
+
+
+def dump(manager, f, value=None, paths=None, indent=None, chunk_size=64 * 1024, between_chunks=None):
+	"""As iter_json(), but writes each chunk to f, which may be a file or a socket.
+	If given, between_chunks is called after each chunk, eg. gevent.idle to let other greenlets run."""
+	write = f.sendall if hasattr(f, 'sendall') else f.write
+	for chunk in iter_json(manager, value, paths, indent, chunk_size):
+		write(chunk)
+		if between_chunks:
+			between_chunks()
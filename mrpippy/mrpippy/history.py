@@ -0,0 +1,199 @@
+
+from array import array
+from bisect import bisect_left, bisect_right
+import time
+
+from datavalues import ValueType
+
+
+NUMERIC_TYPES = {
+	ValueType.BOOL, ValueType.INT_8, ValueType.UINT_8, ValueType.INT_32, ValueType.UINT_32, ValueType.FLOAT,
+}
+
+
+class TimeSeries(object):
+	"""A ring buffer of (timestamp, value) samples, stored as two array('d')s so each sample
+	takes 16 bytes. The arrays grow as needed until capacity samples have been appended,
+	then each new one replaces the oldest. Timestamps must be appended in non-decreasing order."""
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.times = array('d')
+		self.values = array('d')
+		# index the next sample goes in, and number of samples held
+		self.head = 0
+		self.count = 0
+
+	def __len__(self):
+		return self.count
+
+	def __repr__(self):
+		return "<{cls.__name__} {self.count}/{self.capacity}>".format(cls=type(self), self=self)
+	__str__ = __repr__
+
+	@property
+	def nbytes(self):
+		return (len(self.times) + len(self.values)) * self.times.itemsize
+
+	def append(self, timestamp, value):
+		if self.count < self.capacity:
+			self.times.append(timestamp)
+			self.values.append(value)
+			self.count += 1
+		else:
+			self.times[self.head] = timestamp
+			self.values[self.head] = value
+		self.head = (self.head + 1) % self.capacity
+
+	def latest(self):
+		"""Returns the most recent (timestamp, value), or None if empty"""
+		if not self.count:
+			return
+		index = self.head - 1
+		return self.times[index], self.values[index]
+
+	def _segments(self):
+		"""Returns the (start, end) index ranges holding samples, oldest first"""
+		if self.count < self.capacity:
+			return [(0, self.count)]
+		return [(self.head, self.capacity), (0, self.head)]
+
+	def _find(self, timestamp, search):
+		"""Returns the position (counting from the oldest sample) as per search (bisect_left or bisect_right)"""
+		position = 0
+		for start, end in self._segments():
+			index = search(self.times, timestamp, start, end)
+			if index < end:
+				return position + index - start
+			position += end - start
+		return position
+
+	def _slice(self, buf, first, last):
+		"""Returns an array of buf for positions first to last (counting from the oldest sample)"""
+		if self.count < self.capacity:
+			return buf[first:last]
+		start = self.head + first
+		end = self.head + last
+		if end <= self.capacity:
+			return buf[start:end]
+		if start >= self.capacity:
+			return buf[start - self.capacity:end - self.capacity]
+		return buf[start:] + buf[:end - self.capacity]
+
+	def range(self, start=None, end=None):
+		"""Returns (timestamps, values) as arrays of the samples with start <= timestamp < end.
+		start and end default to the oldest and newest samples respectively."""
+		first = 0 if start is None else self._find(start, bisect_left)
+		last = self.count if end is None else self._find(end, bisect_left)
+		last = max(first, last)
+		return self._slice(self.times, first, last), self._slice(self.values, first, last)
+
+	def at(self, timestamp):
+		"""Returns the value as of timestamp, ie. that of the last sample at or before it,
+		or None if there are no samples that old."""
+		position = self._find(timestamp, bisect_right)
+		if position == 0:
+			return
+		return self.values[(self.head - self.count + position - 1) % self.capacity]
+
+	def downsample(self, interval, start=None, end=None):
+		"""Returns a list of (bucket start, min, mean, max) of the samples in range(start, end),
+		grouped into buckets interval seconds long (aligned to multiples of interval).
+		Buckets with no samples are omitted. Note samples are only recorded on change,
+		so the mean is per sample, not weighted by time."""
+		timestamps, values = self.range(start, end)
+		buckets = []
+		first = 0
+		while first < len(timestamps):
+			bucket_start = timestamps[first] - timestamps[first] % interval
+			# always make progress, even if rounding puts the boundary before the first sample
+			last = max(first + 1, bisect_left(timestamps, bucket_start + interval, first))
+			bucket = values[first:last]
+			buckets.append((bucket_start, min(bucket), sum(bucket) / len(bucket), max(bucket)))
+			first = last
+		return buckets
+
+
+class HistoryRecorder(object):
+	"""Records the values of a set of numeric paths over time.
+	To use, set manager.history = HistoryRecorder(), and every DATA_UPDATE applied by
+	decode_and_update() (or reconcile()) records a sample for each path whose value changed.
+	Then query it with recorder[path] or the methods below, which take the same paths.
+	When manager.history is None (the default), no overhead is incurred.
+	"""
+	DEFAULT_PATHS = [
+		('PlayerInfo', 'CurrHP'),
+		('PlayerInfo', 'XPLevel'),
+		('PlayerInfo', 'XPProgressPct'),
+		('PlayerInfo', 'CurrWeight'),
+		('Map', 'World', 'Player', 'X'),
+		('Map', 'World', 'Player', 'Y'),
+	]
+	# about 3.6 hours of 10Hz samples per path, using at most 2MB each
+	CAPACITY = 2**17
+
+	def __init__(self, paths=DEFAULT_PATHS, capacity=CAPACITY):
+		"""paths are tuples of keys and indexes from the root. Each keeps up to capacity samples."""
+		self.series = {tuple(path): TimeSeries(capacity) for path in paths}
+		# maps path: id it resolved to as of _structure_version, or None
+		self._ids = {}
+		self._structure_version = None
+
+	def __getitem__(self, path):
+		return self.series[tuple(path)]
+
+	def __repr__(self):
+		return "<{cls.__name__} {paths} paths, {samples} samples>".format(
+			cls=type(self),
+			paths=len(self.series),
+			samples=sum(len(series) for series in self.series.values()),
+		)
+	__str__ = __repr__
+
+	@property
+	def nbytes(self):
+		return sum(series.nbytes for series in self.series.values())
+
+	def _resolve(self, manager, path):
+		"""Returns the id at path, or None if it doesn't exist"""
+		id = 0
+		for key in path:
+			value = manager.id_map.get(id)
+			if value is None:
+				return
+			if value.value_type == ValueType.OBJECT:
+				id = value.raw_value.get(key)
+			elif value.value_type == ValueType.ARRAY and isinstance(key, int) and 0 <= key < len(value.raw_value):
+				id = value.raw_value[key]
+			else:
+				return
+		return id
+
+	def sample(self, manager, now=None):
+		"""Record the current value of each path in manager, if it has changed since the last sample.
+		Paths that don't exist or aren't numeric are skipped. now defaults to the current time."""
+		if now is None:
+			now = time.time()
+		if manager.structure_version != self._structure_version:
+			self._ids = {path: self._resolve(manager, path) for path in self.series}
+			self._structure_version = manager.structure_version
+		for path, id in self._ids.items():
+			value = manager.id_map.get(id)
+			if value is None or value.value_type not in NUMERIC_TYPES:
+				continue
+			series = self.series[path]
+			latest = series.latest()
+			if latest is None or latest[1] != value.raw_value:
+				series.append(now, value.raw_value)
+
+	def range(self, path, start=None, end=None):
+		"""See TimeSeries.range()"""
+		return self[path].range(start, end)
+
+	def at(self, path, timestamp):
+		"""See TimeSeries.at()"""
+		return self[path].at(timestamp)
+
+	def downsample(self, path, interval, start=None, end=None):
+		"""See TimeSeries.downsample()"""
+		return self[path].downsample(interval, start, end)
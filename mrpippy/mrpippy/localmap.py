@@ -1,6 +1,12 @@
 
 from common import pack, unpack
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
 class LocalMap(object):
 	"""This structure is still very unknown in purpose and semantics."""
 
@@ -29,3 +35,32 @@ class LocalMap(object):
 		northeast, data = unpack('ff', data)
 		southwest, data = unpack('ff', data)
 		return cls(width, height, northwest, northeast, southwest, data)
+
+	@property
+	def array(self):
+		"""The pixels as a read-only numpy array of shape (height, width), one byte per pixel.
+		This is a view onto the pixel data, not a copy. Requires numpy."""
+		if numpy is None:
+			raise ImportError("LocalMap.array requires numpy")
+		return numpy.frombuffer(self.pixels, dtype=numpy.uint8, count=self.width * self.height).reshape(self.height, self.width)
+
+	def dirty_tiles(self, previous=None, tile_size=32):
+		"""Compare against a previous LocalMap and return a list of (x, y, pixels) for each
+		tile_size square tile which has changed, where pixels is a view into self.array
+		(tiles on the right and bottom edges may be smaller).
+		If previous is None or a different size, all tiles are returned. Requires numpy."""
+		current = self.array
+		if not current.size:
+			return []
+		rows = range(0, self.height, tile_size)
+		cols = range(0, self.width, tile_size)
+		if previous is None or (previous.width, previous.height) != (self.width, self.height):
+			dirty = numpy.ones((len(rows), len(cols)), dtype=bool)
+		else:
+			changed = current != previous.array
+			dirty = numpy.logical_or.reduceat(changed, rows, axis=0)
+			dirty = numpy.logical_or.reduceat(dirty, cols, axis=1)
+		return [
+			(x, y, current[y:y + tile_size, x:x + tile_size])
+			for y, x in (numpy.argwhere(dirty) * tile_size).tolist()
+		]
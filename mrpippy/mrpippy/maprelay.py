@@ -0,0 +1,120 @@
+
+from binascii import hexlify, unhexlify
+import zlib
+
+from common import pack, unpack
+from localmap import LocalMap
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class FrameType(object):
+	KEYFRAME = 0
+	DELTA = 1
+
+
+class MissingKeyframe(Exception):
+	"""A delta frame could not be applied because the frame it is based on is not known,
+	eg. because a frame was lost or the viewer joined mid-stream. The viewer needs a new keyframe."""
+	pass
+
+
+def xor(a, b):
+	"""XOR two equal-length byte strings"""
+	if numpy is not None:
+		return (numpy.frombuffer(a, numpy.uint8) ^ numpy.frombuffer(b, numpy.uint8)).tobytes()
+	if not a:
+		return ''
+	# python's big ints let us do this in a handful of C-speed operations instead of per-byte
+	result = '{:x}'.format(int(hexlify(a), 16) ^ int(hexlify(b), 16))
+	return unhexlify(result.zfill(len(a) * 2))
+
+
+class MapRelayEncoder(object):
+	"""Encodes a stream of LocalMaps for relaying to downstream viewers.
+	Each frame is either a keyframe containing the full compressed pixel data,
+	or a delta containing the compressed XOR against the previous frame. As maps change little
+	between frames, deltas are mostly zeroes and compress very well.
+	Each frame only needs to be encoded once no matter how many viewers it is sent to.
+	"""
+
+	def __init__(self, keyframe_interval=30, level=6):
+		"""A keyframe is sent at least every keyframe_interval frames, so that viewers
+		can recover from lost frames. level is the zlib compression level."""
+		self.keyframe_interval = keyframe_interval
+		self.level = level
+		self.sequence = -1
+		self.previous = None
+		self.since_keyframe = 0
+		self._keyframe = None
+
+	def _encode(self, frame_type, local_map, pixels):
+		data = pack('BI', frame_type, self.sequence)
+		# Everything but the pixels is small, so we re-use LocalMap's encoding of it.
+		data += LocalMap(
+			local_map.width, local_map.height,
+			local_map.northwest, local_map.northeast, local_map.southwest,
+			'',
+		).encode()
+		return data + zlib.compress(pixels, self.level)
+
+	def encode(self, local_map, keyframe=False):
+		"""Encode the next frame in the stream and return the encoded string.
+		A keyframe is produced if keyframe=True, if keyframe_interval frames have passed since the last one,
+		or if the previous frame can't be used as a base (eg. the map changed size)."""
+		previous, self.previous = self.previous, local_map
+		self.sequence = (self.sequence + 1) % 2**32
+		self._keyframe = None
+		if (
+			keyframe
+			or previous is None
+			or self.since_keyframe + 1 >= self.keyframe_interval
+			or len(previous.pixels) != len(local_map.pixels)
+		):
+			self.since_keyframe = 0
+			self._keyframe = self._encode(FrameType.KEYFRAME, local_map, local_map.pixels)
+			return self._keyframe
+		self.since_keyframe += 1
+		return self._encode(FrameType.DELTA, local_map, xor(previous.pixels, local_map.pixels))
+
+	def keyframe(self):
+		"""Return a keyframe for the most recently encoded frame, or None if there isn't one yet.
+		This should be sent to new viewers joining the stream, after which they can decode
+		any following frames. The result is cached, so many viewers joining is cheap."""
+		if self.previous is None:
+			return
+		if self._keyframe is None:
+			self._keyframe = self._encode(FrameType.KEYFRAME, self.previous, self.previous.pixels)
+		return self._keyframe
+
+
+class MapRelayDecoder(object):
+	"""Decodes a stream of frames from a MapRelayEncoder back into LocalMaps."""
+
+	def __init__(self):
+		self.sequence = None
+		self.previous = None
+
+	def decode(self, data):
+		"""Decode a frame and return the resulting LocalMap.
+		Raises MissingKeyframe if given a delta that can't be applied to the last decoded frame."""
+		(frame_type, sequence), data = unpack('BI', data, as_tuple=True)
+		header = LocalMap.decode(data)
+		pixels = zlib.decompress(header.pixels)
+		if frame_type == FrameType.DELTA:
+			if (
+				self.previous is None
+				or sequence != (self.sequence + 1) % 2**32
+				or len(self.previous.pixels) != len(pixels)
+			):
+				raise MissingKeyframe("Can't apply delta frame {} to frame {}".format(sequence, self.sequence))
+			pixels = xor(self.previous.pixels, pixels)
+		elif frame_type != FrameType.KEYFRAME:
+			raise ValueError("Unknown frame type {!r}".format(frame_type))
+		header.pixels = pixels
+		self.sequence = sequence
+		self.previous = header
+		return header
@@ -0,0 +1,65 @@
+
+from collections import defaultdict, deque
+import time
+
+
+class ChurnProfiler(object):
+	"""Counts updates and encoded bytes per id over a sliding window of time.
+	To use, set manager.profiler = ChurnProfiler(), then look at top() to find the chattiest values.
+	When manager.profiler is None (the default), no profiling overhead is incurred.
+	"""
+
+	def __init__(self, window=60, buckets=60):
+		"""Counts older than window seconds are discarded. The window slides in
+		steps of window / buckets seconds."""
+		self.window = window
+		self.bucket_length = float(window) / buckets
+		# each bucket is (start time, updates dict {id: count}, bytes dict {id: count})
+		self.buckets = deque()
+
+	def _bucket(self, now):
+		"""Returns the current bucket, creating it and expiring old ones as needed"""
+		if not self.buckets or now >= self.buckets[-1][0] + self.bucket_length:
+			self.buckets.append((now, defaultdict(lambda: 0), defaultdict(lambda: 0)))
+		while self.buckets[0][0] <= now - self.window:
+			self.buckets.popleft()
+		return self.buckets[-1]
+
+	def record(self, updates):
+		"""Takes an iterable of (id, value_type, value, size) as yielded by PipDataManager.decode(sizes=True),
+		counts each one and yields (id, value_type, value)."""
+		start, update_counts, byte_counts = self._bucket(time.time())
+		for id, value_type, value, size in updates:
+			update_counts[id] += 1
+			byte_counts[id] += size
+			yield id, value_type, value
+
+	def totals(self):
+		"""Returns ({id: updates}, {id: bytes}) over the current window"""
+		self._bucket(time.time())
+		update_totals = defaultdict(lambda: 0)
+		byte_totals = defaultdict(lambda: 0)
+		for start, update_counts, byte_counts in self.buckets:
+			for id, count in update_counts.items():
+				update_totals[id] += count
+			for id, count in byte_counts.items():
+				byte_totals[id] += count
+		return update_totals, byte_totals
+
+	def top(self, manager, n=10, by='updates'):
+		"""Returns a list of up to n (path, updates, bytes) for the ids with the most updates
+		(or bytes, if by='bytes') in the current window, most first.
+		Path is a '/'-separated string of keys and indexes from the root.
+		Ids which are not (or no longer) reachable from the root are given as '<id N>'."""
+		update_totals, byte_totals = self.totals()
+		totals = {'updates': update_totals, 'bytes': byte_totals}[by]
+		ids = sorted(totals, key=lambda id: totals[id], reverse=True)[:n]
+		paths = manager.path_map()
+		return [
+			(
+				'/'.join(map(str, paths[id])) if id in paths else '<id {}>'.format(id),
+				update_totals[id],
+				byte_totals[id],
+			)
+			for id in ids
+		]
@@ -1,5 +1,11 @@
 
+from collections import defaultdict, namedtuple
 import json
+import time
+
+from common import Histogram
+from data.inventory import Item, ITEM_TYPES
+from datavalues import ValueType
 
 class RequestType(object):
 	UseItem = 0 
@@ -96,16 +102,54 @@ class LocationMarkerType(object):
 
 # TODO this probably isn't complete
 HAS_REPLY = {
+	RequestType.CheckFastTravel,
 	RequestType.FastTravel,
 }
 
 
+class RPCError(Exception):
+	pass
+
+
+class RPCTimeout(RPCError):
+	"""No response was received before the request's deadline"""
+	pass
+
+
+class RPCCancelled(RPCError):
+	"""The request was cancelled before a response was received"""
+	pass
+
+
+class TooManyOutstanding(RPCError):
+	"""Can't create a new request as max_outstanding requests are already awaiting responses"""
+	pass
+
+
+# callback and errback are as given to create_request, sent and deadline are epoch times
+OutstandingCall = namedtuple('OutstandingCall', ['request_type', 'callback', 'errback', 'sent', 'deadline'])
+
+
 class RPCManager(object):
 	"""Manager for client RPC calls. Keeps track of what has been answered and
-	executes callback(response dict) when it gets a response."""
-	def __init__(self):
+	executes callback(response dict) when it gets a response.
+	Requests expecting a response may have a deadline, after which they are expired by expire().
+	You should call expire() periodically (eg. once a second) for this to happen.
+	Round trip times are recorded per request type in self.latencies.
+	"""
+	def __init__(self, timeout=None, max_outstanding=None):
+		"""timeout is the default timeout for requests expecting a response, or None for no timeout.
+		max_outstanding, if given, is the most requests that may be awaiting a response at once."""
 		self.next_id = 0
-		self.outstanding = {} # maps id: callback
+		self.outstanding = {} # maps id: OutstandingCall
+		self.timeout = timeout
+		self.max_outstanding = max_outstanding
+		self.latencies = defaultdict(Histogram) # maps request type: Histogram of response times
+
+	@staticmethod
+	def expects_reply(name):
+		"""Whether requests created by the named method (eg. 'use_item') expect a response"""
+		return REQUEST_TYPES[name] in HAS_REPLY
 
 	def allocate_id(self):
 		current = self.next_id
@@ -115,49 +159,151 @@ class RPCManager(object):
 	def create_request(self, request_type, *args, **kwargs):
 		"""Create a request message to send, using the next available rpc id.
 		Optional kwarg callback, if request type expects a response, will be called
-		upon that response being recv()'d
+		upon that response being recv()'d.
+		Optional kwarg errback will instead be called with an RPCError if the request times out
+		or is cancelled.
+		Optional kwarg timeout overrides the default timeout for this request.
 		"""
 		callback = kwargs.pop('callback', None)
+		errback = kwargs.pop('errback', None)
+		timeout = kwargs.pop('timeout', self.timeout)
 		if kwargs:
 			raise TypeError("Unexpected kwargs: {}".format(kwargs))
 		if callback and request_type not in HAS_REPLY:
 			raise ValueError("Request type {} does not expect a response".format(request_type))
+		if callback and self.max_outstanding is not None and len(self.outstanding) >= self.max_outstanding:
+			self.expire()
+			if len(self.outstanding) >= self.max_outstanding:
+				raise TooManyOutstanding("Already awaiting {} responses".format(len(self.outstanding)))
 		request = {
 			'id': self.allocate_id(),
 			'type': request_type,
 			'args': args,
 		}
 		if callback:
-			self.outstanding[request['id']] = callback
+			now = time.time()
+			deadline = None if timeout is None else now + timeout
+			self.outstanding[request['id']] = OutstandingCall(request_type, callback, errback, now, deadline)
 		return json.dumps(request)
 
 	def recv(self, response):
 		response = json.loads(response)
 		if response['id'] not in self.outstanding:
-			raise ValueError("Response for unknown id {}: {}".format(response['id']), response)
-		self.outstanding.pop(response['id'])(response)
+			if response['id'] < self.next_id:
+				return # late response for a request that was expired or cancelled
+			raise ValueError("Response for unknown id {}: {}".format(response['id'], response))
+		call = self.outstanding.pop(response['id'])
+		self.latencies[call.request_type].add(time.time() - call.sent)
+		call.callback(response)
+
+	def expire(self, now=None):
+		"""Expire any outstanding requests whose deadline has passed, calling their errbacks.
+		Returns the list of expired ids."""
+		if now is None:
+			now = time.time()
+		expired = [
+			id for id, call in self.outstanding.items()
+			if call.deadline is not None and call.deadline <= now
+		]
+		for id in expired:
+			self._fail(id, RPCTimeout("Request {} timed out".format(id)))
+		return expired
+
+	def cancel(self, id):
+		"""Stop waiting for a response to the given request id, calling its errback.
+		Does nothing if the request is not outstanding."""
+		if id in self.outstanding:
+			self._fail(id, RPCCancelled("Request {} cancelled".format(id)))
+
+	def cancel_all(self):
+		"""Cancel all outstanding requests, eg. because the connection was lost."""
+		for id in list(self.outstanding):
+			self.cancel(id)
+
+	def _fail(self, id, ex):
+		call = self.outstanding.pop(id)
+		if call.errback:
+			call.errback(ex)
 
 	# specific methods for creating requests
 
-	def use_item(self, handle_id, version):
+	def use_item(self, handle_id, version, **kwargs):
 		"""Use item with given handle id from inventory.
 		eg. consume aid, or equip weapon.
 		Version is likely a means to avoid race conditions, assumedly must be current."""
-		return self.create_request(RequestType.UseItem, handle_id, 0, version)
+		return self.create_request(RequestType.UseItem, handle_id, 0, version, **kwargs)
 
-	def toggle_radio_station(self, id):
+	def drop_item(self, handle_id, count, version, stack_ids, **kwargs):
+		"""Drop count of the item with given handle id from inventory.
+		stack_ids is the list of stack ids for the item, as given by Item.stack_id."""
+		return self.create_request(RequestType.DropItem, handle_id, count, version, stack_ids, **kwargs)
+
+	def set_favorite(self, handle_id, stack_ids, slot, version, **kwargs):
+		"""Assign item with given handle id to the favorite slot between 0 and 11.
+		See Item.favorite_slot."""
+		return self.create_request(RequestType.SetFavorite, handle_id, stack_ids, slot, version, **kwargs)
+
+	def toggle_component_favorite(self, form_id, version, **kwargs):
+		"""Toggle whether the crafting component with given form id is tagged for search"""
+		return self.create_request(RequestType.ToggleComponentFavorite, form_id, version, **kwargs)
+
+	def sort_inventory(self, sort_mode, **kwargs):
+		"""Set the inventory sort mode"""
+		return self.create_request(RequestType.SortInventory, sort_mode, **kwargs)
+
+	def toggle_quest_active(self, form_id, instance, quest_type, **kwargs):
+		"""Toggle whether the given quest is active (ie. shown on the map and compass)"""
+		return self.create_request(RequestType.ToggleQuestActive, form_id, instance, quest_type, **kwargs)
+
+	def set_custom_map_marker(self, x, y, on_local_map=False, **kwargs):
+		"""Place the player's custom marker at the given world coords"""
+		return self.create_request(RequestType.SetCustomMapMarker, x, y, on_local_map, **kwargs)
+
+	def remove_custom_map_marker(self, **kwargs):
+		return self.create_request(RequestType.RemoveCustomMapMarker, **kwargs)
+
+	def check_fast_travel(self, location_id, **kwargs):
+		"""Check whether the player can currently fast travel to the location with given data id"""
+		return self.create_request(RequestType.CheckFastTravel, location_id, **kwargs)
+
+	def fast_travel(self, location_id, **kwargs):
+		"""Fast travel to the location with given data id"""
+		return self.create_request(RequestType.FastTravel, location_id, **kwargs)
+
+	def clear_idle(self, **kwargs):
+		return self.create_request(RequestType.ClearIdle, **kwargs)
+
+	def toggle_radio_station(self, id, **kwargs):
 		"""Activate radio station with given data id in the Radios array.
 		If already active, deactivate it instead, leaving no station on."""
-		return self.create_request(RequestType.ToggleRadioStation, id)
+		return self.create_request(RequestType.ToggleRadioStation, id, **kwargs)
+
+	def request_local_map_snapshot(self, **kwargs):
+		"""Ask the server to send the current local map.
+		Note the map arrives as a LOCAL_MAP_UPDATE message, not as a response to this request."""
+		return self.create_request(RequestType.RequestLocalMapSnapshot, **kwargs)
+
+	def move_local_map(self, x, y, **kwargs):
+		"""Pan the local map. Exact semantics of the arguments are not yet known."""
+		return self.create_request(RequestType.MoveLocalMap, x, y, **kwargs)
+
+	def zoom_local_map(self, zoom, **kwargs):
+		"""Zoom the local map. Exact semantics of the argument are not yet known."""
+		return self.create_request(RequestType.ZoomLocalMap, zoom, **kwargs)
 
 
 class RPCServer(object):
 	"""Helper for responding to RPC calls as the server.
 	Automatically dispatches incoming requests to the appropriate method.
-	Method defaults will return reasonable "no-ops" where applicable.
-	It is intended that you override these with meaningful implementations.
+	If given a PipDataManager, the default methods simulate the game by modifying the data
+	(eg. equipping items or changing radio station). The changed values are recorded,
+	and the resulting DATA_UPDATE payload can be fetched with pop_updates().
+	Without a manager, or for requests we don't know how to simulate, methods are no-ops.
+	You may override these with other implementations, using set() to modify values.
+	Methods return a response dict for request types in HAS_REPLY, and None otherwise.
 	"""
-	# map from RequestType to the method name
+	# map from RequestType to the method name.
+	# RPCManager uses the same names for the methods creating each request type.
 	DISPATCH = {
 		RequestType.UseItem: 'use_item',
 		RequestType.DropItem: 'drop_item',
@@ -176,12 +322,202 @@ class RPCServer(object):
 		RequestType.ClearIdle: 'clear_idle',
 	}
 
+	SUCCESS = {'allowed': True, 'success': True}
+	FAILURE = {'allowed': False, 'success': False}
+
+	# the equipState an item gets when equipped, by inventory category
+	EQUIP_STATE = {
+		'29': 1, # apparel
+		'43': 4, # weapons, except grenades which are 3
+	}
+
+	def __init__(self, manager=None):
+		self.manager = manager
+		self.changed = {} # maps id: raw value before it was first changed
+
 	def get_response(self, request):
+		"""Handle an encoded request, returning the encoded response or None if there is no response."""
 		request = json.loads(request)
-		id = request.pop('id')
+		if request['type'] not in self.DISPATCH:
+			raise ValueError("Unknown request type {!r}".format(request['type']))
 		method = getattr(self, self.DISPATCH[request['type']])
 		response = method(*request['args'])
-		response['id'] = id
-		return response
+		if request['type'] not in HAS_REPLY:
+			return
+		response = dict(self.SUCCESS if response is None else response)
+		response['id'] = request['id']
+		return json.dumps(response)
+
+	def set(self, pipvalue, value):
+		"""Change the value of a PipValue, recording it to be sent by pop_updates().
+		For OBJECTs, value should be the new dict {key: value id}."""
+		if pipvalue.id not in self.changed:
+			self.changed[pipvalue.id] = pipvalue.raw_value
+		if pipvalue.value_type == ValueType.OBJECT:
+			removed = [value_id for key, value_id in pipvalue.raw_value.items() if value.get(key) != value_id]
+			added = {key: value_id for key, value_id in value.items() if pipvalue.raw_value.get(key) != value_id}
+			value = added, removed
+		pipvalue.update(value)
+
+	def pop_updates(self):
+		"""Returns an encoded DATA_UPDATE payload of all values changed since the last call,
+		or None if nothing has changed. The changes are committed, so new snapshots see them."""
+		changed, self.changed = self.changed, {}
+		if not changed:
+			return
+		self.manager.commit()
+		return ''.join(
+			self.manager.id_map[id].encode(prev_state)
+			if self.manager.id_map[id].value_type == ValueType.OBJECT
+			else self.manager.id_map[id].encode()
+			for id, prev_state in changed.items()
+			if id in self.manager.id_map
+		)
+
+	def _get(self, *path):
+		"""Return the PipValue at path from root, or None if it (or the manager) doesn't exist"""
+		if not self.manager or not self.manager.root:
+			return
+		value = self.manager.root
+		for key in path:
+			if key not in value:
+				return
+			value = value[key]
+		return value
+
+	def find_item(self, handle_id):
+		"""Return (category, item PipValue) for the inventory item with given handle id,
+		or (None, None) if it isn't found."""
+		inventory = self._get('Inventory')
+		if inventory is None:
+			return None, None
+		for category in ITEM_TYPES:
+			if category not in inventory:
+				continue
+			for item in inventory[category]:
+				if 'HandleID' in item and item['HandleID'].raw_value == handle_id:
+					return category, item
+		return None, None
+
+	def _remove_item(self, category, item):
+		items = self._get('Inventory', category)
+		self.set(items, tuple(value_id for value_id in items.raw_value if value_id != item.id))
+
+	def use_item(self, handle_id, unknown, version):
+		"""Aid items are consumed, equippable items are equipped or unequipped"""
+		category, item = self.find_item(handle_id)
+		if item is None:
+			return
+		if category == '48':
+			self.drop_item(handle_id, 1, version, [])
+			return
+		if 'equipState' not in item or category not in self.EQUIP_STATE:
+			return
+		if item['equipState'].raw_value:
+			self.set(item['equipState'], 0)
+			return
+		state = self.EQUIP_STATE[category]
+		if category == '43' and item['text'].raw_value.lower() in Item.GRENADE_NAMES:
+			state = 3
+		if state != 1:
+			# only one weapon or grenade may be equipped at once
+			for other in self._get('Inventory', category):
+				if 'equipState' in other and other['equipState'].raw_value == state:
+					self.set(other['equipState'], 0)
+		self.set(item['equipState'], state)
+
+	def drop_item(self, handle_id, count, version, stack_ids):
+		category, item = self.find_item(handle_id)
+		if item is None:
+			return
+		remaining = item['count'].raw_value - count
+		if remaining > 0:
+			self.set(item['count'], remaining)
+		else:
+			self._remove_item(category, item)
+
+	def set_favorite(self, handle_id, stack_ids, slot, version):
+		"""Assigns item to slot, removing whatever was previously in that slot.
+		If the item is already in that slot, it is removed instead."""
+		category, item = self.find_item(handle_id)
+		if item is None or 'favorite' not in item:
+			return
+		if item['favorite'].raw_value == slot:
+			self.set(item['favorite'], -1)
+			return
+		for other_category in ITEM_TYPES:
+			for other in self._get('Inventory', other_category) or []:
+				if 'favorite' in other and other['favorite'].raw_value == slot:
+					self.set(other['favorite'], -1)
+		self.set(item['favorite'], slot)
+
+	def toggle_component_favorite(self, form_id, version):
+		for component in self._get('Inventory', 'invComponents') or []:
+			if component['ComponentFormID'].raw_value == form_id:
+				tagged = component['taggedForSearch']
+				self.set(tagged, not tagged.raw_value)
+
+	def sort_inventory(self, sort_mode):
+		value = self._get('Inventory', 'sortMode')
+		if value is not None:
+			self.set(value, sort_mode)
+
+	def toggle_quest_active(self, form_id, instance, quest_type):
+		for quest in self._get('Quests') or []:
+			if (quest['formID'].raw_value, quest['instance'].raw_value, quest['type'].raw_value) == (form_id, instance, quest_type):
+				self.set(quest['enabled'], not quest['enabled'].raw_value)
+
+	def set_custom_map_marker(self, x, y, on_local_map):
+		marker = self._get('Map', 'World', 'CustomMarker')
+		if marker is None:
+			return
+		self.set(marker['X'], x)
+		self.set(marker['Y'], y)
+		self.set(marker['Visible'], True)
+
+	def remove_custom_map_marker(self):
+		visible = self._get('Map', 'World', 'CustomMarker', 'Visible')
+		if visible is not None:
+			self.set(visible, False)
+
+	def check_fast_travel(self, location_id):
+		if self.manager and location_id not in self.manager.id_map:
+			return self.FAILURE
+		return self.SUCCESS
+
+	def fast_travel(self, location_id):
+		"""Moves the player to the location's coordinates"""
+		if self.manager is None:
+			return self.SUCCESS
+		if location_id not in self.manager.id_map:
+			return self.FAILURE
+		location = self.manager.id_map[location_id]
+		player = self._get('Map', 'World', 'Player')
+		if player is not None and 'X' in location and 'Y' in location:
+			self.set(player['X'], location['X'].raw_value)
+			self.set(player['Y'], location['Y'].raw_value)
+		return self.SUCCESS
+
+	def move_local_map(self, x, y):
+		pass
+
+	def zoom_local_map(self, zoom):
+		pass
+
+	def toggle_radio_station(self, id):
+		"""Activates the station with given id, deactivating all others.
+		If it was already active, deactivates it instead."""
+		for radio in self._get('Radio') or []:
+			active = radio.id == id and not radio['active'].raw_value
+			if radio['active'].raw_value != active:
+				self.set(radio['active'], active)
+
+	def request_local_map_snapshot(self):
+		pass
+
+	def clear_idle(self):
+		pass
+
 
-	# TODO
+# maps from RPCManager method name to the RequestType it creates
+REQUEST_TYPES = {name: request_type for request_type, name in RPCServer.DISPATCH.items()}
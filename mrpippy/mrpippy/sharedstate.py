@@ -0,0 +1,246 @@
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from datavalues import PipValue, ValueType
+
+
+MAGIC = 'PIPS'
+LAYOUT_VERSION = 1
+# magic, layout version, padding, sequence, record count, data length
+HEADER = struct.Struct('<4sHHQII')
+SEQUENCE_OFFSET = 8
+COUNT_OFFSET = 16
+INDEX_ENTRY = struct.Struct('<II')
+
+DEFAULT_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'mrpippy-state')
+
+
+class SharedStateWriter(object):
+	"""Publishes a PipDataManager's state into a memory-mapped file, so other processes on the same
+	machine can read it with a SharedStateReader instead of needing their own connection.
+	There should only be one writer per path.
+
+	The layout is:
+		header: magic, layout version, sequence number, record count, data length (see HEADER)
+		index: (id, offset) for each record, sorted by id
+		records: each value as encoded in a DATA_UPDATE (OBJECTs with all their keys as added)
+	Offsets are relative to the start of the index.
+	The sequence number is a sequence lock: it is odd while a publish is in progress.
+	"""
+
+	def __init__(self, path=DEFAULT_PATH, size=16 * 2**20):
+		"""Creates (or truncates) path to size bytes. publish() raises ValueError if the state
+		doesn't fit, as readers can't follow the file being resized."""
+		self.path = path
+		self.size = size
+		self.file = open(path, 'w+b')
+		self.file.truncate(size)
+		self.map = mmap.mmap(self.file.fileno(), size)
+		self.sequence = 0
+		HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, 0, self.sequence, 0, 0)
+
+	def publish(self, manager):
+		"""Write the manager's full current state. Readers see either the old or the new state, never a mix.
+		Encoding is done before taking the lock, so readers are only held up for the copy."""
+		ids = sorted(manager.id_map)
+		index_length = INDEX_ENTRY.size * len(ids)
+		records = []
+		offsets = []
+		offset = index_length
+		for id in ids:
+			record = manager.id_map[id].encode()
+			records.append(record)
+			offsets.append(id)
+			offsets.append(offset)
+			offset += len(record)
+		data = struct.pack('<' + 'II' * len(ids), *offsets) + ''.join(records)
+		if HEADER.size + len(data) > self.size:
+			raise ValueError("State is {} bytes, but shared file {} is only {} bytes".format(
+				HEADER.size + len(data), self.path, self.size,
+			))
+		self._set_sequence(self.sequence + 1)
+		self.map[HEADER.size:HEADER.size + len(data)] = data
+		struct.pack_into('<II', self.map, COUNT_OFFSET, len(ids), len(data))
+		self._set_sequence(self.sequence + 1)
+
+	def _set_sequence(self, sequence):
+		self.sequence = sequence
+		struct.pack_into('<Q', self.map, SEQUENCE_OFFSET, sequence)
+
+	def close(self, unlink=True):
+		self.map.close()
+		self.file.close()
+		if unlink:
+			os.remove(self.path)
+
+
+class SharedStateReader(object):
+	"""Reads state published by a SharedStateWriter, possibly in another process.
+	All methods return a consistent view as of a single publish(), retrying if the writer was mid-publish."""
+	# how long to wait between retries while the writer is mid-publish
+	RETRY_INTERVAL = 0.0001
+
+	def __init__(self, path=DEFAULT_PATH):
+		self.path = path
+		with open(path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, layout_version, _, _, _, _ = HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC:
+			raise ValueError("{} is not a shared state file".format(path))
+		if layout_version != LAYOUT_VERSION:
+			raise ValueError("{} has layout version {}, expected {}".format(path, layout_version, LAYOUT_VERSION))
+		# decoded records {id: (value_type, raw_value)} as of self._cache_sequence.
+		# Since the sequence never goes backwards, records decoded during a publish are never used.
+		self._cache = {}
+		self._cache_sequence = None
+
+	@property
+	def sequence(self):
+		"""Changes whenever new state is published. Odd while a publish is in progress."""
+		sequence, = struct.unpack_from('<Q', self.map, SEQUENCE_OFFSET)
+		return sequence
+
+	def read(self, func, *args):
+		"""Call func(*args) until it completes without the writer publishing in the meantime, and return the result.
+		Errors are only raised if they weren't caused by reading a half-written state."""
+		while True:
+			done, result = self._attempt(func, *args)
+			if done:
+				return result
+			time.sleep(self.RETRY_INTERVAL)
+
+	def _attempt(self, func, *args):
+		"""Call func(*args) once, returning (True, result) if the writer didn't publish in the meantime,
+		otherwise (False, None)."""
+		sequence = self.sequence
+		if sequence % 2 == 0:
+			try:
+				result = func(*args)
+			except Exception:
+				if self.sequence == sequence:
+					raise
+			else:
+				if self.sequence == sequence:
+					return True, result
+		return False, None
+
+	def _view(self):
+		"""Returns a _StateView directly over the mapped file. Not consistent, see read()."""
+		sequence = self.sequence
+		if sequence != self._cache_sequence:
+			self._cache = {}
+			self._cache_sequence = sequence
+		count, length = struct.unpack_from('<II', self.map, COUNT_OFFSET)
+		return _StateView(self.map, HEADER.size, count, length, self._cache)
+
+	def _copy(self):
+		"""Returns a _StateView over a private copy of the state. Not consistent, see read()."""
+		count, length = struct.unpack_from('<II', self.map, COUNT_OFFSET)
+		return _StateView(self.map[HEADER.size:HEADER.size + length], 0, count, length)
+
+	def get(self, id):
+		"""Returns (value_type, raw_value) for id, or None if it doesn't exist.
+		OBJECT raw values are a dict {key: id}, ARRAYs a tuple of ids. These are cached, so should not be modified."""
+		return self.read(lambda: self._view().find(id))
+
+	def lookup(self, *path):
+		"""Returns the id at the given path of keys and indexes from the root, eg. lookup('PlayerInfo', 'CurrHP').
+		Raises KeyError or IndexError if it doesn't exist."""
+		return self.read(lambda: self._view().resolve(path))
+
+	def value(self, *path):
+		"""Returns the fully dereferenced value at the given path, as per PipValue.value.
+		Since this may read many records, if the writer publishes while we're reading we retry from
+		a copy of the state, so that a busy writer can't keep forcing us to start again."""
+		done, result = self._attempt(lambda: self._view().value(path))
+		if done:
+			return result
+		return self.read(self._copy).value(path)
+
+	def close(self):
+		self.map.close()
+
+
+class _StateView(object):
+	"""Decodes records from a buffer in the shared layout, where the index starts at offset base"""
+
+	def __init__(self, data, base, count, length, cache=None):
+		self.data = data
+		self.base = base
+		self.count = count
+		self.length = length
+		self.cache = {} if cache is None else cache
+
+	def find(self, id):
+		"""Returns (value_type, raw_value) for id, or None if it doesn't exist"""
+		if id not in self.cache:
+			self.cache[id] = self._decode(id)
+		return self.cache[id]
+
+	def _decode(self, id):
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			mid_id, offset = INDEX_ENTRY.unpack_from(self.data, self.base + mid * INDEX_ENTRY.size)
+			if mid_id < id:
+				lo = mid + 1
+			elif mid_id > id:
+				hi = mid
+			else:
+				break
+		else:
+			return
+		if mid + 1 < self.count:
+			_, end = INDEX_ENTRY.unpack_from(self.data, self.base + (mid + 1) * INDEX_ENTRY.size)
+		else:
+			end = self.length
+		record = self.data[self.base + offset:self.base + end]
+		value_type, record_id = struct.unpack_from('<BI', record)
+		value, _ = PipValue.decode(value_type, record[struct.calcsize('<BI'):])
+		if value_type == ValueType.OBJECT:
+			value, removed = value
+		return value_type, value
+
+	def resolve(self, path):
+		"""Returns the id at path (a sequence of OBJECT keys and ARRAY indexes) from the root.
+		Raises KeyError or IndexError if it doesn't exist."""
+		id = 0
+		for key in path:
+			found = self.find(id)
+			if found is None:
+				raise KeyError(id)
+			value_type, raw_value = found
+			if value_type not in (ValueType.OBJECT, ValueType.ARRAY):
+				raise KeyError(key)
+			id = raw_value[key]
+		return id
+
+	def value(self, path):
+		"""As per PipValue.value for the value at path"""
+		to_build = [self.resolve(path)]
+		# first decode everything below path, then assemble it from the leaves up
+		found = {}
+		while to_build:
+			id = to_build.pop()
+			if id in found:
+				continue
+			found[id] = self.find(id)
+			if found[id] is None:
+				raise KeyError(id)
+			value_type, raw_value = found[id]
+			if value_type == ValueType.OBJECT:
+				to_build += raw_value.values()
+			elif value_type == ValueType.ARRAY:
+				to_build += raw_value
+		def build(id):
+			value_type, raw_value = found[id]
+			if value_type == ValueType.OBJECT:
+				return {key: build(child) for key, child in raw_value.items()}
+			if value_type == ValueType.ARRAY:
+				return [build(child) for child in raw_value]
+			return raw_value
+		return build(self.resolve(path))
@@ -7,4 +7,7 @@ setup(
 	author_email="mikelang3000@gmail.com",
 	description="protocol logic for the Fallout 4 Pip-boy companion app",
 	packages=find_packages(),
+	extras_require={
+		'numpy': ['numpy'],
+	},
 )